@@ -0,0 +1,200 @@
+"""Measures the client-side cost of the Queue API.
+
+Requests are served in-process by iron_mq_fake, or over HTTP on a local port
+with --http, so results do not depend on the network. Time spent inside the
+stand-in is measured separately; the rest of the latency, reported as client
+time, is spent in iron_mq, iron_core and the transport.
+
+    python benchmark.py
+    python benchmark.py --sizes 100,10000 --json > results.json
+    python benchmark.py --compare results.json --tolerance 0.2
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+from iron_mq import IronMQ, PooledTransport, json
+from iron_mq_fake import FakeIronMQ
+
+
+class _TimedFake(FakeIronMQ):
+    server_time = 0.0
+
+    def handle(self, method, url, body=""):
+        started = time.perf_counter()
+        try:
+            return FakeIronMQ.handle(self, method, url, body)
+        finally:
+            self.server_time += time.perf_counter() - started
+
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # Before Python 3.9 only clearing the traces resets the peak.
+        tracemalloc.clear_traces()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _measure(name, size, calls, per_call, fake, setup, operation):
+    """Runs operation calls times on the state returned by setup(calls) and
+    returns a result dict.
+    """
+    state = setup(calls)
+    latencies = []
+    fake.server_time = 0.0
+    started = time.perf_counter()
+    for i in range(calls):
+        call_started = time.perf_counter()
+        operation(state, i)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    server_time = fake.server_time
+
+    # A second, shorter pass under tracemalloc, which slows calls down. The
+    # peak is taken per call, above the memory traced before it.
+    traced_calls = max(1, min(calls, 50))
+    state = setup(traced_calls)
+    peaks = []
+    tracemalloc.start()
+    for i in range(traced_calls):
+        _reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        operation(state, i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'size': size,
+        'calls': calls,
+        'messages_per_call': per_call,
+        'msgs_per_sec': calls * per_call / elapsed,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'client_us_per_call': (elapsed - server_time) / calls * 1e6,
+        'peak_alloc_kb_per_call': sum(peaks) / 1024.0 / traced_calls,
+    }
+
+
+def run(sizes, calls, http=False, codec=None, pooled=False):
+    fake = _TimedFake()
+    server = None
+    if http:
+        server = fake.serve()
+        transport = PooledTransport() if pooled else None
+        mq = IronMQ(codec=codec, transport=transport, **server.config)
+    else:
+        mq = fake.client(codec=codec)
+    results = []
+
+    try:
+        for size in sizes:
+            body = 'x' * size
+
+            def fresh_queue(fill=0):
+                mq.create_queue('benchmark')
+                q = mq.queue('benchmark')
+                q.clear()
+                for i in range(0, fill, 100):
+                    q.post(*[body] * min(100, fill - i))
+                return q
+
+            results.append(_measure(
+                'post', size, calls, 1, fake, lambda count: fresh_queue(),
+                lambda q, i: q.post(body)))
+            results.append(_measure(
+                'post_batch_100', size, max(1, calls // 10), 100, fake,
+                lambda count: fresh_queue(),
+                lambda q, i: q.post(*[body] * 100)))
+            for n in (1, 10, 100):
+                results.append(_measure(
+                    'reserve_%d' % n, size, max(1, calls // n), n, fake,
+                    lambda count, n=n: fresh_queue(count * n),
+                    lambda q, i, n=n: q.reserve(max=n, timeout=3600)))
+
+            def reserved(count):
+                q = fresh_queue(count * 100)
+                batches = [q.reserve(max=100, timeout=3600) for i in range(count)]
+                return q, batches
+
+            results.append(_measure(
+                'delete_multiple_100', size, max(1, calls // 10), 100, fake, reserved,
+                lambda state, i: state[0].delete_multiple(messages=state[1][i])))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns descriptions of results slower than baseline by more than
+    tolerance, as a fraction.
+    """
+    previous = dict(((r['name'], r['size']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get((result['name'], result['size']))
+        if old is None:
+            continue
+        if result['msgs_per_sec'] < old['msgs_per_sec'] * (1 - tolerance):
+            regressions.append("%s (%d bytes): %.0f msgs/sec, was %.0f" % (
+                result['name'], result['size'], result['msgs_per_sec'],
+                old['msgs_per_sec']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated message body sizes, in bytes')
+    parser.add_argument('--calls', type=int, default=500,
+                        help='number of calls per single message benchmark')
+    parser.add_argument('--http', action='store_true',
+                        help='serve the API over HTTP instead of in-process')
+    parser.add_argument('--pooled', action='store_true',
+                        help='with --http, keep connections alive with PooledTransport')
+    parser.add_argument('--codec', default=None,
+                        help='JSON codec of the client: json, orjson, ujson or auto')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed throughput drop when comparing')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.calls, http=args.http, codec=args.codec,
+                  pooled=args.pooled)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-20s %8s %12s %9s %9s %14s %12s" % (
+            'benchmark', 'size', 'msgs/sec', 'p50 ms', 'p99 ms',
+            'client us/call', 'peak KB/call'))
+        for r in results:
+            print("%-20s %8d %12.0f %9.3f %9.3f %14.1f %12.1f" % (
+                r['name'], r['size'], r['msgs_per_sec'], r['p50_ms'],
+                r['p99_ms'], r['client_us_per_call'],
+                r['peak_alloc_kb_per_call']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("Regression: %s\n" % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,353 @@
+import atexit
+import base64
+import collections
+import email.utils
+import hashlib
+import heapq
+import io
+import itertools
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 import iron_core
+import requests
+import urllib3
 
 try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
 
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue
+
 try:
     import json
 except:
     import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 try:
     basestring
 except NameError:
     basestring = str
 
+_replace = getattr(os, 'replace', os.rename)
+
+log = logging.getLogger(__name__)
+
+# Message bodies rewritten by the client start with this prefix, followed by
+# a JSON header and a newline. See _wrap_body() and _unwrap_body().
+ENVELOPE_PREFIX = '#iron_mq1:'
+
+
+def _wrap_body(header, payload):
+    return '%s%s\n%s' % (ENVELOPE_PREFIX,
+                         json.dumps(header, separators=(',', ':'), sort_keys=True),
+                         payload)
+
+
+def _dedup_key(body):
+    """Returns the dedup_key a message body was posted with, or None, and
+    the body without it.
+    """
+    header, payload = _unwrap_body(body)
+    if header is None or 'k' not in header:
+        return None, body
+    return header['k'], payload
+
+
+def _unwrap_body(body):
+    """Returns the header dict and payload of an enveloped message body, or
+    None and the body itself if it is not enveloped.
+    """
+    if not isinstance(body, basestring) or not body.startswith(ENVELOPE_PREFIX):
+        return None, body
+    header, _, payload = body[len(ENVELOPE_PREFIX):].partition('\n')
+    try:
+        return json.loads(header), payload
+    except ValueError:
+        return None, body
+
+
+_COMPRESSORS = {
+    'zlib': (lambda data, level: zlib.compress(data, 6 if level is None else level),
+             zlib.decompress),
+}
+if zstandard is not None:
+    _COMPRESSORS['zstd'] = (
+        lambda data, level: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 is not None:
+    _COMPRESSORS['lz4'] = (
+        lambda data, level: lz4.frame.compress(data, compression_level=level or 0),
+        lz4.frame.decompress)
+
+
+class Compression(object):
+    """Compresses message bodies of at least threshold characters.
+
+    Compressed bodies are base64 encoded in an envelope naming the
+    algorithm, so that consumers decompress them whatever compression they
+    were configured with. Bodies that would not get smaller are left alone.
+    """
+
+    def __init__(self, algorithm='zlib', threshold=1024, level=None):
+        """Keyword arguments:
+        algorithm -- 'zlib', or 'zstd' and 'lz4' if zstandard and lz4 are
+                     installed.
+        threshold -- The minimum length of a body to compress.
+        level -- The compression level. Defaults to the algorithm's default.
+        """
+        if algorithm not in _COMPRESSORS:
+            raise ValueError('%s compression is not available.' % algorithm)
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, body):
+        """Returns body compressed, if it is worth it."""
+        if not isinstance(body, basestring) or len(body) < self.threshold:
+            return body
+        compressed = _COMPRESSORS[self.algorithm][0](body.encode('utf-8'), self.level)
+        wrapped = _wrap_body({'c': self.algorithm},
+                             base64.b64encode(compressed).decode('ascii'))
+        if len(wrapped) >= len(body):
+            return body
+        return wrapped
+
+    def decode(self, body):
+        """Returns body decompressed, if it was compressed."""
+        header, payload = _unwrap_body(body)
+        if header is None or 'c' not in header:
+            return body
+        if header['c'] not in _COMPRESSORS:
+            raise ValueError('%s compression is not available.' % header['c'])
+        data = _COMPRESSORS[header['c']][1](base64.b64decode(payload))
+        return data.decode('utf-8')
+
+
+class FileBlobStore(object):
+    """Stores the bodies of claim-checked messages as files in a directory.
+
+    Other stores, e.g. for an object storage service, need the same put(),
+    get(), open() and delete() methods.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, data):
+        """Stores data, as bytes, and returns its key."""
+        key = uuid.uuid4().hex
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        _replace(path + '.tmp', path)
+        return key
+
+    def get(self, key):
+        """Returns the data stored under key, as bytes."""
+        with self.open(key) as f:
+            return f.read()
+
+    def open(self, key):
+        """Returns a binary file object to read the data stored under key
+        from.
+        """
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        """Deletes the data stored under key, if any."""
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class ClaimCheck(object):
+    """Moves message bodies of at least threshold characters to a blob
+    store, and posts a reference to them in their place.
+
+    Referenced bodies are loaded from the store when messages are decoded,
+    or on first access to the body of a Message. Bodies of messages reserved
+    or peeked by this client are deleted from the store when the messages
+    are deleted with Queue.delete() or delete_multiple().
+    """
+
+    def __init__(self, store, threshold=64 * 1024, max_tracked=100000):
+        """Arguments:
+        store -- The blob store, e.g. a FileBlobStore.
+        threshold -- The minimum length of a body to move to the store.
+        max_tracked -- The maximum number of message ids whose blobs are
+                       remembered for deletion.
+        """
+        self.store = store
+        self.threshold = threshold
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()  # message id -> blob key
+
+    def encode(self, body):
+        """Stores body and returns a reference to it, if it is large enough."""
+        if not isinstance(body, basestring) or len(body) < self.threshold:
+            return body
+        data = body.encode('utf-8')
+        return _wrap_body({'r': self.store.put(data), 'n': len(data)}, '')
+
+    def key(self, body):
+        """Returns the blob key body references, or None."""
+        header = _unwrap_body(body)[0]
+        if header is None:
+            return None
+        return header.get('r')
+
+    def track(self, message_id, body):
+        """Remembers the blob referenced by the body of a message, so that it
+        is deleted with the message. Returns its key, or None.
+        """
+        key = self.key(body)
+        if key is not None:
+            with self._lock:
+                self._keys[message_id] = key
+                while len(self._keys) > self.max_tracked:
+                    self._keys.popitem(last=False)
+        return key
+
+    def decode(self, message_id, body):
+        """Returns the body a message body references, or the body itself."""
+        key = self.track(message_id, body)
+        if key is None:
+            return body
+        return self.store.get(key).decode('utf-8')
+
+    def open(self, message_id, body):
+        """Returns a binary file object reading the body a message body
+        references, or the body itself.
+        """
+        key = self.track(message_id, body)
+        if key is None:
+            return io.BytesIO(body.encode('utf-8'))
+        return self.store.open(key)
+
+    def discard(self, message_ids):
+        """Deletes the blobs of deleted messages."""
+        with self._lock:
+            keys = [self._keys.pop(id) for id in message_ids if id in self._keys]
+        for key in keys:
+            try:
+                self.store.delete(key)
+            except Exception:
+                log.exception("Failed to delete blob %s", key)
+
 
 class Queue(object):
     client = None
     name = None
+    cache = None
+    compression = None
+    claim_check = None
 
-    def __init__(self, mq, name):
+    def __init__(self, mq, name, compression=None, claim_check=None):
         """Creates object for manipulating a queue.
 
         Arguments:
         mq -- An instance of IronMQ.
         name -- The name of the queue.
+        compression -- Optional. A Compression for message bodies posted to
+                       the queue. Compressed bodies of reserved or peeked
+                       messages are then decompressed.
+        claim_check -- Optional. A ClaimCheck moving large message bodies
+                       posted to the queue to a blob store.
         """
         self.client = mq.client
         self.name = name
+        self.cache = mq.cache
+        self.compression = compression
+        self.claim_check = claim_check
 
     def info(self):
         """Execute an HTTP request to get details on a queue, and
-        return it.
+        return it. If the client caches queue details, cached details may
+        be returned instead.
         """
+        if self.cache is not None:
+            return self.cache.get(self.name, self._fetch_info)
+        return self._fetch_info()
+
+    def _fetch_info(self):
         url = "queues/%s" % (self.name,)
         result = self.client.get(url)
 
         return result['body']['queue']
 
+    def _invalidate(self):
+        if self.cache is not None:
+            self.cache.invalidate(self.name)
+
     def size(self):
         """Queue size"""
         return self.info()['size']
@@ -55,8 +364,9 @@ class Queue(object):
         """Executes an HTTP request to clear all contents of a queue."""
         url = "queues/%s/messages" % self.name
         result = self.client.delete(url = url,
-                                    body = json.dumps({}),
+                                    body = self.client.codec.dumps({}),
                                     headers={'Content-Type': 'application/json'})
+        self._invalidate()
 
         return result['body']
 
@@ -74,10 +384,13 @@ class Queue(object):
             qitems['reservation_id'] = reservation_id
         if subscriber_name is not None:
             qitems['subscriber_name'] = subscriber_name
-        body = json.dumps(qitems)
+        body = self.client.codec.dumps(qitems)
 
         result = self.client.delete(url=url, body=body,
                                     headers={'Content-Type': 'application/json'})
+        self._invalidate()
+        if self.claim_check is not None:
+            self.claim_check.discard([message_id])
 
         return result['body']
 
@@ -88,8 +401,6 @@ class Queue(object):
         ids -- A list of messages id to be deleted from the queue.
         messages -- Response to message reserving.
         """
-        url = "queues/%s/messages" % self.name
-
         items = None
         if ids is None and messages is None:
              raise Exception('Please, specify at least one parameter.')
@@ -98,11 +409,20 @@ class Queue(object):
         if messages is not None:
            items = [{'id': item['id'], 'reservation_id': item['reservation_id']} for item in
                  messages['messages']]
+        return self._delete_items(items)
 
-        data = json.dumps({'ids': items})
+    def _delete_items(self, items):
+        """Deletes messages given as dicts of their id and, for reserved
+        messages, reservation_id, with one request.
+        """
+        url = "queues/%s/messages" % self.name
+        data = self.client.codec.dumps({'ids': items})
 
         result = self.client.delete(url=url, body=data,
                                     headers={'Content-Type': 'application/json'})
+        self._invalidate()
+        if self.claim_check is not None:
+            self.claim_check.discard([item['id'] for item in items])
         return result['body']
 
     def post(self, *messages):
@@ -110,19 +430,136 @@ class Queue(object):
         Creates queue if not existed.
 
         Arguments:
-        messages -- An array of messages to be added to the queue.
+        messages -- An array of messages to be added to the queue. Message
+                    dicts may have a dedup_key, which identifies copies of
+                    a message for a Deduplicator.
         """
-        url = "queues/%s/messages" % self.name
+        msgs = [self._message(msg) for msg in messages]
+        data = self.client.codec.dumps({'messages': msgs})
+
+        try:
+            return self._post_data(data)
+        except Exception as e:
+            self._delete_blobs(msgs, e)
+            raise
+
+    def _delete_blobs(self, msgs, error):
+        """Deletes the claim-check blobs of encoded messages whose post
+        failed with error, unless the service may have stored the messages
+        regardless, e.g. when the connection dropped after the request was
+        sent.
+        """
+        if self.claim_check is None or not _not_processed(error):
+            return
+        for msg in msgs:
+            key = self.claim_check.key(_dedup_key(msg['body'])[1])
+            if key is None:
+                continue
+            try:
+                self.claim_check.store.delete(key)
+            except Exception:
+                log.exception("Failed to delete blob %s", key)
+
+    def _message(self, msg):
+        if isinstance(msg, basestring):
+            msg = {'body': msg}
+        body = msg['body']
+        if self.claim_check is not None:
+            body = self.claim_check.encode(body)
+        if self.compression is not None and body is msg['body']:
+            body = self.compression.encode(body)
+        if 'dedup_key' in msg:
+            msg = dict(msg)
+            body = _wrap_body({'k': msg.pop('dedup_key')}, body)
+        elif body is msg['body']:
+            return msg
+        else:
+            msg = dict(msg)
+        msg['body'] = body
+        return msg
 
-        msgs = [{'body': msg} if isinstance(msg, basestring) else msg
-                for msg in messages]
-        data = json.dumps({'messages': msgs})
+    def _decode_messages(self, messages):
+        for message in messages:
+            body = message['body']
+            if isinstance(body, basestring) and body.startswith(ENVELOPE_PREFIX):
+                key, body = _dedup_key(body)
+                if key is not None:
+                    message['dedup_key'] = key
+                try:
+                    message['body'] = self._decode_body(message['id'], body)
+                except Exception as e:
+                    # One message whose blob is gone must not fail the
+                    # others: it keeps its encoded body, with the error.
+                    log.warning("Failed to decode the body of message %s from %s: %s",
+                                message['id'], self.name, e)
+                    message['body'] = body
+                    message['decode_error'] = e
+        return messages
 
+    def _decode_body(self, message_id, body):
+        if self.claim_check is not None:
+            body = self.claim_check.decode(message_id, body)
+        if self.compression is not None:
+            body = self.compression.decode(body)
+        return body
+
+    def post_encoded(self, data):
+        """Executes an HTTP request to create messages on the queue from an
+        already encoded request body.
+
+        Arguments:
+        data -- JSON of the form {"messages": [{"body": ...}, ...]}, as str or
+                bytes, e.g. as returned by queue.client.codec.dumps().
+        """
+        return self._post_data(data)
+
+    def _post_data(self, data):
+        url = "queues/%s/messages" % self.name
         result = self.client.post(url=url, body=data,
                                   headers={'Content-Type': 'application/json'})
+        self._invalidate()
 
         return result['body']
 
+    def producer(self, max_batch=100, max_bytes=1024 * 1024, linger_ms=5):
+        """Returns a BatchingProducer that posts to this queue in batches.
+
+        Arguments:
+        max_batch -- The maximum number of messages per request. Max is 100.
+        max_bytes -- The maximum encoded size of a request body, in bytes.
+        linger_ms -- How long a message may wait for a batch to fill up, in milliseconds.
+        """
+        return BatchingProducer(self, max_batch=max_batch,
+                                max_bytes=max_bytes, linger_ms=linger_ms)
+
+    def spool(self, directory, **kwargs):
+        """Returns a Spool that posts to this queue from a durable local
+        spool in directory. See Spool for the other arguments.
+        """
+        return Spool(self, directory, **kwargs)
+
+    def consumer(self, handler, concurrency=1, prefetch=None, wait=30,
+                 timeout=None, ack_batch=100, ack_interval=0.5, tuner=None,
+                 dedup=None):
+        """Returns a Consumer that feeds messages of this queue to handler.
+        See Consumer for the arguments.
+        """
+        return Consumer(self, handler, concurrency=concurrency,
+                        prefetch=prefetch, wait=wait, timeout=timeout,
+                        ack_batch=ack_batch, ack_interval=ack_interval,
+                        tuner=tuner, dedup=dedup)
+
+    def consume(self, handler, concurrency=1, prefetch=None, wait=30,
+                timeout=None, ack_batch=100, ack_interval=0.5, tuner=None,
+                dedup=None):
+        """Processes messages of this queue with handler until interrupted.
+        See Consumer for the arguments.
+        """
+        self.consumer(handler, concurrency=concurrency, prefetch=prefetch,
+                      wait=wait, timeout=timeout, ack_batch=ack_batch,
+                      ack_interval=ack_interval, tuner=tuner,
+                      dedup=dedup).run()
+
     def get(self, max=None, timeout=None, wait=None):
         """Deprecated. Use Queue.reserve() instead. Executes an HTTP request to get a message off of a queue.
 
@@ -133,7 +570,8 @@ class Queue(object):
         return response
 
 
-    def reserve(self, max=None, timeout=None, wait=None, delete=None):
+    def reserve(self, max=None, timeout=None, wait=None, delete=None, raw=False,
+                objects=False):
         """Retrieves Messages from the queue and reserves it.
 
         Arguments:
@@ -141,7 +579,11 @@ class Queue(object):
         timeout -- Timeout in seconds.
         wait -- Time to long poll for messages, in seconds. Max is 30 seconds. Default 0.
         delete -- If true, do not put each message back on to the queue after reserving. Default false.
+        raw -- If true, return the response body as undecoded bytes. Default false.
+        objects -- If true, return a MessageBatch of Message objects instead of the response body. Default false.
         """
+        if raw and objects:
+            raise ValueError('raw and objects are mutually exclusive.')
         url = "queues/%s/reservations" % self.name
         qitems = {}
         if max is not None:
@@ -152,28 +594,44 @@ class Queue(object):
             qitems['wait'] = wait
         if delete is not None:
             qitems['delete'] = delete
-        body = json.dumps(qitems)
+        body = self.client.codec.dumps(qitems)
 
-        response = self.client.post(url, body=body,
-                                    headers={'Content-Type': 'application/json'})
+        response = self.client.request(url, "POST", body=body,
+                                       headers={'Content-Type': 'application/json'},
+                                       raw=raw)
+        if objects:
+            return self._batch(response['body']['messages'])
+        if not raw:
+            self._decode_messages(response['body']['messages'])
 
         return response['body']
 
 
-    def get_message_by_id(self, message_id):
+    def get_message_by_id(self, message_id, objects=False):
         url = "queues/%s/messages/%s" % (self.name, message_id)
         response = self.client.get(url)
-        return response['body']['message']
+        if objects:
+            return Message(self, response['body']['message'])
+        return self._decode_messages([response['body']['message']])[0]
 
-    def peek(self, max=None):
+    def peek(self, max=None, raw=False, objects=False):
+        if raw and objects:
+            raise ValueError('raw and objects are mutually exclusive.')
         url = "queues/%s/messages" % self.name
         if max is not None:
             url = "%s?n=%s" % (url, max)
 
-        response = self.client.get(url)
+        response = self.client.request(url, "GET", raw=raw)
+        if objects:
+            return self._batch(response['body']['messages'])
+        if not raw:
+            self._decode_messages(response['body']['messages'])
 
         return response['body']
 
+    def _batch(self, messages):
+        return MessageBatch(self, [Message(self, message) for message in messages])
+
     def touch(self, message_id, reservation_id, timeout=None):
         """Touching a reserved message extends its timeout to the duration specified when the message was created.
 
@@ -186,7 +644,7 @@ class Queue(object):
         qitems = {'reservation_id': reservation_id}
         if timeout is not None:
             qitems['timeout'] = timeout
-        body = json.dumps(qitems)
+        body = self.client.codec.dumps(qitems)
 
         response = self.client.post(url, body=body,
                                     headers={'Content-Type': 'application/json'})
@@ -205,55 +663,169 @@ class Queue(object):
         body = {'reservation_id': reservation_id}
         if delay > 0:
             body['delay'] = delay
-        body = json.dumps(body)
+        body = self.client.codec.dumps(body)
 
         response = self.client.post(url, body=body,
                                     headers={'Content-Type': 'application/json'})
 
         return response['body']
 
+    def delete_many(self, ids=None, messages=None, chunk_size=100, max_workers=8):
+        """Deletes any number of messages, with concurrent requests of up to
+        chunk_size messages each. Returns a BulkResult.
+
+        If deleting a chunk fails, its messages are deleted one by one, so
+        that the result tells which of them could not be deleted.
+
+        Arguments:
+        ids -- A list of messages id to be deleted from the queue.
+        messages -- Response to message reserving, or a list of reserved messages.
+        chunk_size -- The number of messages per request. Max is 100.
+        max_workers -- The maximum number of concurrent requests.
+        """
+        if ids is None and messages is None:
+            raise Exception('Please, specify at least one parameter.')
+        items = []
+        if ids is not None:
+            items.extend({'id': id} for id in ids)
+        if messages is not None:
+            items.extend({'id': m['id'], 'reservation_id': m['reservation_id']}
+                         for m in _message_list(messages))
+
+        return self._bulk(items, min(chunk_size, 100), max_workers,
+                          self._delete_chunk)
+
+    def _delete_chunk(self, chunk):
+        """Deletes up to 100 messages with one request, or one by one if that
+        fails, and returns a list of their ids and the exception deleting
+        each raised, or None.
+        """
+        try:
+            self._delete_items(chunk)
+            return [(item['id'], None) for item in chunk]
+        except (requests.RequestException, CircuitOpenError):
+            if len(chunk) == 1:
+                raise
+        outcomes = []
+        for item in chunk:
+            try:
+                self.delete(item['id'], item.get('reservation_id'))
+                outcomes.append((item['id'], None))
+            except Exception as e:
+                outcomes.append((item['id'], e))
+        return outcomes
+
+    def release_many(self, messages, delay=0, max_workers=8):
+        """Releases any number of reserved messages with concurrent requests.
+        Returns a BulkResult.
+
+        Arguments:
+        messages -- Response to message reserving, or a list of reserved messages.
+        delay -- The time after which the messages will be released.
+        max_workers -- The maximum number of concurrent requests.
+        """
+        def release_one(chunk):
+            message = chunk[0]
+            self.release(message['id'], message['reservation_id'], delay)
+            return [(message['id'], None)]
+
+        return self._bulk(_message_list(messages), 1, max_workers, release_one)
+
+    def touch_many(self, messages, timeout=None, max_workers=8):
+        """Touches any number of reserved messages with concurrent requests.
+        Returns a BulkResult whose reservation_ids hold the new reservation
+        id of each touched message.
+
+        Arguments:
+        messages -- Response to message reserving, or a list of reserved messages.
+        timeout -- Optional. The timeout in seconds after which new reservations will expire.
+        max_workers -- The maximum number of concurrent requests.
+        """
+        def touch_one(chunk):
+            message = chunk[0]
+            response = self.touch(message['id'], message['reservation_id'], timeout)
+            return [(message['id'], response['reservation_id'])]
+
+        return self._bulk(_message_list(messages), 1, max_workers, touch_one)
+
+    def _bulk(self, items, chunk_size, max_workers, operation):
+        result = BulkResult()
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        if not chunks:
+            return result
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)))
+        try:
+            futures = [(chunk, executor.submit(operation, chunk)) for chunk in chunks]
+            for chunk, future in futures:
+                try:
+                    outcomes = future.result()
+                except Exception as e:
+                    outcomes = [(item['id'], e) for item in chunk]
+                for id, outcome in outcomes:
+                    if isinstance(outcome, Exception):
+                        result.failed[id] = outcome
+                    else:
+                        result.succeeded.append(id)
+                        if outcome is not None:
+                            result.reservation_ids[id] = outcome
+        finally:
+            executor.shutdown()
+        return result
+
+    def leases(self, timeout=None, margin=None, max_workers=4):
+        """Returns a LeaseManager that keeps reservations on this queue alive.
+        See LeaseManager for the arguments.
+        """
+        return LeaseManager(self, timeout=timeout, margin=margin,
+                            max_workers=max_workers)
+
     def update(self, options=None):
         url = "queues/%s" % self.name
 
-        body = json.dumps({})
+        body = self.client.codec.dumps({})
         if options is not None:
-            body = json.dumps({'queue': options})
+            body = self.client.codec.dumps({'queue': options})
 
         response = self.client.patch(url, body=body,
                                      headers={'Content-Type': 'application/json'})
+        self._invalidate()
         return response['body']['queue']
 
     def delete_queue(self):
         url = "queues/%s" % self.name
 
         response = self.client.delete(url)
+        self._invalidate()
 
         return response['body']
 
     def add_subscribers(self, *subscribers):
         url = "queues/%s/subscribers" % self.name
-        body = json.dumps({'subscribers': subscribers})
+        body = self.client.codec.dumps({'subscribers': subscribers})
 
         response = self.client.post(url, body=body,
                                     headers={'Content-Type': 'application/json'})
+        self._invalidate()
 
         return response['body']
 
     def remove_subscribers(self, *subscribers):
         url = "queues/%s/subscribers" % self.name
-        body = json.dumps(self._prepare_subscribers(*subscribers))
+        body = self.client.codec.dumps(self._prepare_subscribers(*subscribers))
 
         response = self.client.delete(url, body=body,
                                       headers={'Content-Type': 'application/json'})
+        self._invalidate()
 
         return response['body']
 
     def replace_subscribers(self, *subscribers):
         url = "queues/%s/subscribers" % self.name
-        body = json.dumps({'subscribers': subscribers})
+        body = self.client.codec.dumps({'subscribers': subscribers})
 
         response = self.client.put(url, body=body,
                                       headers={'Content-Type': 'application/json'})
+        self._invalidate()
 
         return response['body']
 
@@ -273,100 +845,3289 @@ class Queue(object):
 
         return {'subscribers': subscrs}
 
-class IronMQ(object):
-    NAME = 'iron_mq_python'
-    VERSION = '0.9'
-    API_VERSION = 3
-    client = None
-    name = None
+def _message_list(messages):
+    if isinstance(messages, dict):
+        return messages['messages']
+    return list(messages)
 
-    def __init__(self, name=None, **kwargs):
-        """Prepare a configured instance of the API wrapper and return it.
 
-        Keyword arguments are passed directly to iron_core_python; consult its
-        documentation for a full list and possible values."""
-        if name is not None:
-            self.name = name
-        kwargs['api_version'] = kwargs.get('api_version') or IronMQ.API_VERSION
+class Message(object):
+    """A message of a queue, as returned by Queue.reserve(objects=True),
+    peek(objects=True) and get_message_by_id(objects=True).
 
-        self.client = iron_core.IronClient(name=IronMQ.NAME,
-                version=IronMQ.VERSION, product='iron_mq', **kwargs)
+    The body is decompressed, or loaded from the blob store of a
+    ClaimCheck, on first access. delete(), touch() and release() act on the
+    current reservation of the message; touch() replaces reservation_id
+    with the new one. Fields can also be read as items, e.g. message['id'],
+    by code written for message dicts.
+    """
 
+    __slots__ = ('queue', 'id', 'reservation_id', 'reserved_count',
+                 'dedup_key', '_body', '_decoded')
+    FIELDS = ('id', 'body', 'reservation_id', 'reserved_count', 'dedup_key')
 
-    def queues(self, page=None, per_page=None, previous=None, prefix=None):
-        """Execute an HTTP request to get a list of queues and return it.
+    def __init__(self, queue, data):
+        self.queue = queue
+        self.id = data['id']
+        self.reservation_id = data.get('reservation_id')
+        self.reserved_count = data.get('reserved_count')
+        self.dedup_key = None
+        self._body = data.get('body')
+        self._decoded = True
+        if (isinstance(self._body, basestring) and
+                self._body.startswith(ENVELOPE_PREFIX)):
+            self.dedup_key, self._body = _dedup_key(self._body)
+            self._decoded = False
+            if queue.claim_check is not None:
+                queue.claim_check.track(self.id, self._body)
+
+    @property
+    def body(self):
+        if not self._decoded:
+            self._body = self.queue._decode_body(self.id, self._body)
+            self._decoded = True
+        return self._body
+
+    def open(self):
+        """Returns a binary file object reading the body, streamed from the
+        blob store if the body was moved there by a ClaimCheck.
+        """
+        if not self._decoded and self.queue.claim_check is not None:
+            if self.queue.claim_check.key(self._body) is not None:
+                return self.queue.claim_check.open(self.id, self._body)
+        return io.BytesIO(self.body.encode('utf-8'))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<Message %s>' % self.id
+
+    def delete(self):
+        """Deletes the message from its queue."""
+        return self.queue.delete(self.id, self.reservation_id)
+
+    def touch(self, timeout=None):
+        """Extends the reservation of the message.
 
         Keyword arguments:
-        page -- The 0-based page to get queues from. Defaults to None, which
-                omits the parameter.
+        timeout -- Optional. The timeout in seconds after which the new
+                   reservation will expire.
         """
-        options = {}
-        if page is not None:
-            raise Exception('page param is deprecated!')
-        if per_page is not None:
-            options['per_page'] = per_page
-        if previous is not None:
-            options['previous'] = previous
-        if prefix is not None:
-            options['prefix'] = prefix
+        result = self.queue.touch(self.id, self.reservation_id, timeout=timeout)
+        self.reservation_id = result['reservation_id']
+        return result
 
-        query = urlencode(options)
-        url = 'queues'
-        if query != '':
-            url = "%s?%s" % (url, query)
-        result = self.client.get(url)
+    def release(self, delay=0):
+        """Releases the reserved message back on to its queue.
 
-        return [queue['name'] for queue in result['body']['queues']]
+        Keyword arguments:
+        delay -- The time after which the message will be released.
+        """
+        return self.queue.release(self.id, self.reservation_id, delay=delay)
 
 
-    def queue(self, queue_name):
-        """Returns Queue object.
+class MessageBatch(list):
+    """A list of the Messages returned by one reserve or peek."""
+
+    def __init__(self, queue, messages=()):
+        list.__init__(self, messages)
+        self.queue = queue
+
+    def ack(self):
+        """Deletes all messages of the batch with one request."""
+        return self.queue.delete_multiple(messages={'messages': self})
+
+
+class BulkResult(object):
+    """Outcome of a bulk operation on messages.
+
+    succeeded -- Ids of the messages the operation succeeded for.
+    failed -- A dict of ids of the messages the operation failed for to the
+              exception raised.
+    reservation_ids -- For touch_many, a dict of message ids to their new
+                       reservation id.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+        self.reservation_ids = {}
+
+    @property
+    def ok(self):
+        """True if the operation succeeded for all messages."""
+        return not self.failed
+
+    def __repr__(self):
+        return '<BulkResult succeeded=%d failed=%d>' % (len(self.succeeded),
+                                                        len(self.failed))
+
+
+class BatchingProducer(object):
+    """Buffers messages and posts them to a queue in batches from a
+    background thread.
+
+    A batch is sent as soon as it holds max_batch messages, its encoded size
+    reaches max_bytes, or its oldest message has waited linger_ms
+    milliseconds. post() returns a Future resolving to the id the server
+    assigned to the message.
+    """
+
+    def __init__(self, queue, max_batch=100, max_bytes=1024 * 1024, linger_ms=5):
+        if not 0 < max_batch <= 100:
+            raise ValueError('max_batch must be between 1 and 100.')
+        self.queue = queue
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self.linger = linger_ms / 1000.0
+
+        self._cond = threading.Condition()
+        # [(encoded message, future, enqueued at, encode time,
+        #   message if its body may be claim-checked), ...]
+        self._pending = []
+        self._pending_bytes = 0
+        self._sending = False
+        self._flushing = 0
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='iron_mq-producer-%s' % queue.name)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def post(self, message):
+        """Queues a message for posting and returns a Future of its id.
 
         Arguments:
-        queue_name -- The name of the queue.
+        message -- A message body string or a message dict, as for Queue.post.
         """
-        return Queue(self, queue_name)
+        msg = self.queue._message(message)
+        encoded = self.queue.client.codec.dumps(msg)
+        # Encoding happens here, the request in the background thread.
+        encode_time = _take_encode_time()
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Producer is closed.')
+            self._pending.append((encoded, future, time.time(), encode_time,
+                                  msg if self.queue.claim_check is not None else None))
+            self._pending_bytes += len(encoded) + 1
+            if (len(self._pending) >= self.max_batch or
+                    self._pending_bytes >= self.max_bytes or
+                    len(self._pending) == 1):
+                self._cond.notify_all()
+        return future
 
+    def flush(self, timeout=None):
+        """Sends buffered messages immediately and waits until the server has
+        accepted them. Returns False if timeout expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending or self._sending:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
 
-    def create_queue(self, queue_name, options=None):
-        body = json.dumps({})
-        if options is not None:
-            body = json.dumps({'queue': options})
-        url = "queues/%s" % queue_name
-        response = self.client.put(url, body=body, headers={'Content-Type': 'application/json'})
-        return response['body']['queue']
+    def close(self, timeout=None):
+        """Flushes buffered messages and stops the background thread."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if hasattr(atexit, 'unregister'):
+            atexit.unregister(self.close)
 
+    def __enter__(self):
+        return self
 
-    def update_queue(self, queue_name, options=None):
-        body = json.dumps({})
-        if options is not None:
-            body = json.dumps({'queue': options})
-        url = "queues/%s" % queue_name
-        response = self.client.patch(url, body=body,
-                                       headers={'Content-Type': 'application/json'})
-        return response['body']['queue']
+    def __exit__(self, *exc_info):
+        self.close()
 
+    def _ready(self, now):
+        return (self._closed or self._flushing or
+                len(self._pending) >= self.max_batch or
+                self._pending_bytes >= self.max_bytes or
+                now - self._pending[0][2] >= self.linger)
 
-    def _prepare_subscribers(self, *subscribers):
-        subscrs = [{'url': ss} for ss in subscribers]
-        return {'subscribers': subscrs}
+    def _take_batch(self):
+        batch = []
+        size = 0
+        for item in self._pending:
+            if batch and (len(batch) >= self.max_batch or
+                          size + len(item[0]) + 1 > self.max_bytes):
+                break
+            batch.append(item)
+            size += len(item[0]) + 1
+        del self._pending[:len(batch)]
+        self._pending_bytes -= size
+        return batch
 
-    # DEPRECATED
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._pending and self._ready(now):
+                        break
+                    if self._closed and not self._pending:
+                        return
+                    timeout = None
+                    if self._pending:
+                        timeout = self._pending[0][2] + self.linger - now
+                    self._cond.wait(timeout)
+                batch = self._take_batch()
+                self._sending = True
+            try:
+                self._send(batch)
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
 
-    def getQueues(self, page=None, project_id=None):
-        return self.queues(page=page)
+    def _send(self, batch):
+        started = _clock()
+        encoded = [item[0] for item in batch]
+        if isinstance(encoded[0], bytes):
+            data = b'{"messages": [' + b', '.join(encoded) + b']}'
+        else:
+            data = '{"messages": [%s]}' % ', '.join(encoded)
+        _add_encode_time(_clock() - started + sum(item[3] for item in batch))
+        try:
+            result = self.queue._post_data(data)
+            ids = result['ids']
+        except Exception as e:
+            self.queue._delete_blobs([item[4] for item in batch if item[4] is not None], e)
+            for item in batch:
+                item[1].set_exception(e)
+            return
+        for item, id in zip(batch, ids):
+            item[1].set_result(id)
 
-    def getQueueDetails(self, queue_name, project_id=None):
-        return self.queue(queue_name).info()
 
-    def deleteMessage(self, queue_name, message_id, project_id=None):
-        return self.queue(queue_name).delete(message_id)
+class SpoolFullError(Exception):
+    """Raised by Spool.post() when the spool stays full for longer than its
+    timeout.
+    """
 
-    def postMessage(self, queue_name, messages=[], project_id=None):
-        return self.queue(queue_name).post(*messages)
 
-    def getMessage(self, queue_name, max=None, project_id=None):
-        return self.queue(queue_name).get(max=max)
+# Spooled messages are records of a header, holding the length and CRC-32 of
+# the encoded message, followed by the encoded message.
+_RECORD = struct.Struct('>II')
 
-    def clearQueue(self, queue_name, project_id=None):
-        return self.queue(queue_name).clear()
+
+def _read_record(segment, offset):
+    """Returns the message of the record at offset of a segment mmap and the
+    offset of the next record, or None and offset if there is no intact
+    record there.
+    """
+    start = offset + _RECORD.size
+    if start > len(segment):
+        return None, offset
+    length, crc = _RECORD.unpack_from(segment, offset)
+    if length == 0 or start + length > len(segment):
+        return None, offset
+    message = segment[start:start + length]
+    if zlib.crc32(message) & 0xffffffff != crc:
+        return None, offset
+    return message, start + length
+
+
+class Spool(object):
+    """Durable write-ahead spool of messages to post to a queue.
+
+    post() appends messages to memory-mapped segment files in a directory
+    and returns without waiting for the server. A background thread posts
+    them in batches, in the order they were spooled, and retries a batch
+    until the server accepts it. The position of the last accepted batch is
+    checkpointed, so that a spool opened on the same directory after a
+    crash posts the messages that were not accepted yet. Messages accepted
+    right before a crash may be posted twice.
+
+    Only connection errors, timeouts, 429 and 5xx responses are retried. If
+    the server rejects a batch with another 4xx status, its messages are
+    posted one by one, and those rejected again are appended to the
+    'rejected' file of the directory, one encoded message per line, so that
+    they do not hold up the messages spooled after them.
+
+    Segments are deleted once all their messages were posted. When the
+    spool reaches max_bytes, post() blocks until segments are freed.
+    """
+
+    FSYNC_POLICIES = ('always', 'interval', 'never')
+
+    def __init__(self, queue, directory, segment_bytes=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, fsync='interval',
+                 fsync_interval=1.0, max_batch=100, timeout=None,
+                 retry_delay=1.0, max_retry_delay=30):
+        """Arguments:
+        queue -- The Queue to post to.
+        directory -- The directory of the segment files. Created if missing.
+                     Only one spool may use a directory at a time.
+        segment_bytes -- The size of a segment file, in bytes. Messages must
+                         fit in a segment.
+        max_bytes -- The maximum size of all segment files, in bytes. At
+                     least two segments are used.
+        fsync -- When spooled messages are flushed to disk: 'always', on
+                 every post(); 'interval', at most every fsync_interval
+                 seconds; or 'never', leaving it to the operating system.
+                 Messages survive a crash of the process with any policy,
+                 but only flushed ones survive a crash of the machine.
+        fsync_interval -- Seconds between flushes with fsync='interval'.
+        max_batch -- The maximum number of messages per request. Max is 100.
+        timeout -- How long post() blocks on a full spool before raising
+                   SpoolFullError, in seconds. Defaults to None, which
+                   blocks until there is room.
+        retry_delay -- Seconds before the first retry of a failed batch. The
+                       delay doubles with each failure, up to max_retry_delay.
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError('fsync must be one of %s.' % ', '.join(self.FSYNC_POLICIES))
+        if not 0 < max_batch <= 100:
+            raise ValueError('max_batch must be between 1 and 100.')
+        self.queue = queue
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(2, max_bytes // segment_bytes)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.pending = 0
+        self.posted = 0
+        self.rejected = 0
+
+        self._cond = threading.Condition()
+        self._isolate = 0  # messages to post one by one after a rejection
+        self._segments = {}  # segment number -> mmap
+        # ((segment number, offset), encode time) of records spooled by post()
+        self._encode_times = collections.deque()
+        self._last_sync = time.time()
+        self._closed = False
+        self._stopped = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='iron_mq-spool-%s' % queue.name)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def post(self, *messages):
+        """Spools messages for posting.
+
+        Arguments:
+        messages -- Message body strings or message dicts, as for Queue.post.
+        """
+        records = []
+        for message in messages:
+            encoded = self.queue.client.codec.dumps(self.queue._message(message))
+            if not isinstance(encoded, bytes):
+                encoded = encoded.encode('utf-8')
+            if _RECORD.size + len(encoded) > self.segment_bytes:
+                raise ValueError('Message does not fit in a spool segment.')
+            records.append((encoded, _take_encode_time()))
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Spool is closed.')
+            try:
+                for encoded, encode_time in records:
+                    self._append(encoded, deadline, encode_time)
+            finally:
+                self._cond.notify_all()
+                self._sync(self.fsync == 'always')
+
+    def flush(self, timeout=None):
+        """Waits until the server has accepted all spooled messages. Returns
+        False if timeout expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Posts spooled messages until the spool is empty, a batch fails or
+        timeout expires, then stops the background thread. Messages left
+        are posted by the next spool opened on the directory.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            self._stopped = True
+            self._sync(True)
+            if not self._thread.is_alive():
+                for segment in self._segments.values():
+                    segment.close()
+        if hasattr(atexit, 'unregister'):
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%020d.seg' % number)
+
+    def _map(self, number):
+        fd = os.open(self._path(number), os.O_RDWR | os.O_CREAT)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                os.ftruncate(fd, self.segment_bytes)
+                size = self.segment_bytes
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _recover(self):
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith('.seg') and name[:-4].isdigit())
+        self._read = (numbers[0] if numbers else 0, 0)
+        try:
+            with open(os.path.join(self.directory, 'checkpoint')) as f:
+                segment, offset = f.read().split()
+                self._read = (int(segment), int(offset))
+        except (IOError, OSError, ValueError):
+            pass
+
+        for number in numbers:
+            if number < self._read[0]:
+                os.remove(self._path(number))
+            else:
+                self._segments[number] = self._map(number)
+        if self._read[0] not in self._segments:
+            number = min(self._segments) if self._segments else self._read[0]
+            self._read = (number, 0)
+            if not self._segments:
+                self._segments[number] = self._map(number)
+
+        for number in sorted(self._segments):
+            segment = self._segments[number]
+            offset = self._read[1] if number == self._read[0] else 0
+            while True:
+                message, offset = _read_record(segment, offset)
+                if message is None:
+                    break
+                self.pending += 1
+        self._write = (number, offset)
+        # Clear what may be left of a partly written record.
+        segment[offset:] = b'\0' * (len(segment) - offset)
+
+    def _append(self, encoded, deadline, encode_time=0.0):
+        number, offset = self._write
+        segment = self._segments[number]
+        end = offset + _RECORD.size + len(encoded)
+        if end > len(segment):
+            while len(self._segments) >= self.max_segments:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise SpoolFullError('Spool %s is full.' % self.directory)
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+            if self.fsync != 'never':
+                segment.flush()
+            number, offset = number + 1, 0
+            segment = self._segments[number] = self._map(number)
+            end = _RECORD.size + len(encoded)
+        segment[offset + _RECORD.size:end] = encoded
+        _RECORD.pack_into(segment, offset, len(encoded),
+                          zlib.crc32(encoded) & 0xffffffff)
+        self._encode_times.append(((number, offset), encode_time))
+        self._write = (number, end)
+        self.pending += 1
+
+    def _sync(self, force):
+        now = time.time()
+        if self.fsync == 'never' or not (force or self.fsync == 'interval' and
+                                         now - self._last_sync >= self.fsync_interval):
+            return
+        self._segments[self._write[0]].flush()
+        self._last_sync = now
+
+    def _take_batch(self):
+        number, offset = self._read
+        batch = []
+        limit = 1 if self._isolate else self.max_batch
+        while len(batch) < limit and (number, offset) != self._write:
+            message, next_offset = _read_record(self._segments[number], offset)
+            if message is None:
+                if number == self._write[0]:
+                    break
+                # The rest of a sealed segment is empty.
+                number, offset = number + 1, 0
+                continue
+            batch.append(message)
+            offset = next_offset
+        # Encoding is charged to the first attempt to post the batch.
+        encode_time = 0.0
+        while self._encode_times and self._encode_times[0][0] < (number, offset):
+            encode_time += self._encode_times.popleft()[1]
+        return batch, (number, offset), encode_time
+
+    def _commit(self, count, position, rejected=0):
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d\n' % position)
+            if self.fsync == 'always':
+                f.flush()
+                os.fsync(f.fileno())
+        _replace(path + '.tmp', path)
+        for number in [n for n in self._segments if n < position[0]]:
+            self._segments.pop(number).close()
+            os.remove(self._path(number))
+        self._read = position
+        self.pending -= count
+        self.posted += count - rejected
+        self.rejected += rejected
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            with self._cond:
+                while not self.pending and not self._closed:
+                    self._sync(False)
+                    self._cond.wait(self.fsync_interval if self.fsync == 'interval' else None)
+                if self._stopped or not self.pending:
+                    return
+                batch, position, encode_time = self._take_batch()
+            try:
+                _add_encode_time(encode_time)
+                self.queue._post_data(b'{"messages": [' + b', '.join(batch) + b']}')
+            except Exception as e:
+                if _rejected(e):
+                    with self._cond:
+                        if len(batch) > 1:
+                            # Find the messages the server rejects.
+                            self._isolate = len(batch)
+                            continue
+                        self._reject(batch[0], e, position)
+                        self._cond.notify_all()
+                    continue
+                log.warning("Failed to post %d spooled messages to %s, retrying in %.1fs",
+                            len(batch), self.queue.name, delay, exc_info=True)
+                with self._cond:
+                    deadline = time.time() + delay
+                    while not self._closed and time.time() < deadline:
+                        self._cond.wait(deadline - time.time())
+                    if self._closed:
+                        return
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            with self._cond:
+                self._isolate = max(0, self._isolate - len(batch))
+                self._commit(len(batch), position)
+                self._cond.notify_all()
+
+    def _reject(self, message, error, position):
+        log.error("%s rejected a spooled message, moved to %s: %s",
+                  self.queue.name, os.path.join(self.directory, 'rejected'), error)
+        with open(os.path.join(self.directory, 'rejected'), 'ab') as f:
+            f.write(message + b'\n')
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+        self._isolate = max(0, self._isolate - 1)
+        self._commit(1, position, rejected=1)
+
+
+class _Acker(object):
+    """Collects processed messages and deletes them from a queue in batches
+    from a background thread.
+
+    If a batch can not be deleted, e.g. because the reservation of one of
+    its messages expired, its messages are deleted one by one. failed counts
+    the messages that could not be deleted, and error holds the last
+    exception.
+    """
+
+    def __init__(self, queue, batch=100, interval=0.5):
+        self.queue = queue
+        self.batch = min(batch, 100)
+        self.interval = interval
+        self.failed = 0
+        self.error = None
+        self._cond = threading.Condition()
+        self._pending = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='iron_mq-acker-%s' % queue.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, message):
+        with self._cond:
+            self._pending.append({'id': message['id'],
+                                  'reservation_id': message['reservation_id']})
+            if len(self._pending) >= self.batch:
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch:
+                    self._cond.wait(self.interval)
+                batch = self._pending[:self.batch]
+                del self._pending[:self.batch]
+                if not batch and self._closed:
+                    return
+            if batch:
+                try:
+                    outcomes = self.queue._delete_chunk(batch)
+                except Exception as e:
+                    outcomes = [(item['id'], e) for item in batch]
+                for id, error in outcomes:
+                    if error is not None:
+                        log.warning("Failed to delete message %s from %s: %s",
+                                    id, self.queue.name, error)
+                        self.failed += 1
+                        self.error = error
+
+
+class Consumer(object):
+    """Processes the messages of a queue with a pool of worker threads.
+
+    Messages are reserved ahead of demand with long polling, so that up to
+    prefetch of them are waiting for a worker at any time. A message is
+    deleted once handler returns for it; deletes are sent in batches with
+    Queue.delete_multiple. If handler raises, the message is released back
+    on to the queue.
+    """
+
+    def __init__(self, queue, handler, concurrency=1, prefetch=None, wait=30,
+                 timeout=None, ack_batch=100, ack_interval=0.5, tuner=None,
+                 dedup=None):
+        """Arguments:
+        queue -- The Queue to consume.
+        handler -- A callable, called with each reserved message dict.
+        concurrency -- The number of worker threads.
+        prefetch -- The number of reserved messages to keep waiting for
+                    workers. Defaults to twice the concurrency.
+        wait -- Time to long poll for messages, in seconds. Max is 30 seconds.
+        timeout -- Reservation timeout in seconds. If not set, value from
+                   queue is used.
+        ack_batch -- The maximum number of messages deleted per request.
+        ack_interval -- The longest a processed message waits to be deleted,
+                        in seconds.
+        tuner -- Optional. A ReserveTuner choosing the number of messages,
+                 wait and timeout of each reserve in place of wait and
+                 timeout. A large prefetch leaves it room to batch.
+        dedup -- Optional. A Deduplicator; duplicates of messages processed
+                 already are deleted without calling handler.
+        """
+        self.queue = queue
+        self.handler = handler
+        self.tuner = tuner
+        self.dedup = dedup
+        self.concurrency = concurrency
+        self.prefetch = prefetch or 2 * concurrency
+        self.wait = wait
+        self.timeout = timeout
+
+        self._buffer = _queue.Queue()
+        self._slots = threading.Semaphore(self.prefetch)
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._ack_batch = ack_batch
+        self._ack_interval = ack_interval
+        self._acker = None
+        self._threads = []
+
+    def start(self):
+        """Starts reserving and processing messages in the background."""
+        self._acker = _Acker(self.queue, self._ack_batch, self._ack_interval)
+        self._threads = [threading.Thread(target=self._fetch,
+                                          name='iron_mq-fetch-%s' % self.queue.name)]
+        for i in range(self.concurrency):
+            self._threads.append(threading.Thread(
+                target=self._work,
+                name='iron_mq-worker-%s-%d' % (self.queue.name, i)))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stops reserving messages. Messages already reserved are still
+        processed; use join() to wait for them.
+        """
+        self._stopping.set()
+
+    def join(self, timeout=None):
+        """Waits until the consumer has stopped and deleted processed
+        messages. Returns False if timeout expired first.
+        """
+        return self._stopped.wait(timeout)
+
+    def run(self):
+        """Starts the consumer and blocks until it is stopped from another
+        thread or interrupted with KeyboardInterrupt.
+        """
+        self.start()
+        try:
+            while not self.join(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+            self.join()
+
+    def _fetch(self):
+        try:
+            while not self._stopping.is_set():
+                self._slots.acquire()
+                if self._stopping.is_set():
+                    self._slots.release()
+                    break
+                n = 1
+                while n < 100 and self._slots.acquire(False):
+                    n += 1
+                params = {'timeout': self.timeout, 'wait': self.wait}
+                if self.tuner is not None:
+                    params = self.tuner.params(backlog=self._buffer.qsize(),
+                                               concurrency=self.concurrency)
+                    keep = min(n, params.pop('max'))
+                    for i in range(n - keep):
+                        self._slots.release()
+                    n = keep
+                try:
+                    messages = self.queue.reserve(max=n, **params)['messages']
+                    if self.tuner is not None:
+                        self.tuner.reserved(n, len(messages))
+                except Exception:
+                    log.exception("Failed to reserve messages from %s",
+                                  self.queue.name)
+                    messages = []
+                    self._stopping.wait(1)
+                for i in range(n - len(messages)):
+                    self._slots.release()
+                for message in messages:
+                    self._buffer.put(message)
+        finally:
+            for i in range(self.concurrency):
+                self._buffer.put(None)
+            threading.Thread(target=self._finish).start()
+
+    def _work(self):
+        while True:
+            message = self._buffer.get()
+            if message is None:
+                return
+            self._slots.release()
+            if self._duplicate(message):
+                continue
+            started = _clock()
+            try:
+                self.handler(message)
+            except Exception:
+                log.exception("Handler failed on message %s from %s",
+                              message['id'], self.queue.name)
+                self._release(message)
+            else:
+                self._done(message)
+            if self.tuner is not None:
+                self.tuner.processed(_clock() - started)
+
+    def _duplicate(self, message):
+        """Returns True if message is a duplicate. Deletes it if it was
+        processed already. If it is being processed, as when its reservation
+        expired while a worker was still on it, it is released for later
+        instead, should that attempt fail.
+        """
+        if self.dedup is None:
+            return False
+        new = self.dedup.begin(message)
+        if new:
+            return False
+        log.debug("Skipping duplicate message %s from %s", message['id'],
+                  self.queue.name)
+        if new is False:
+            self._acker.add(message)
+            return True
+        try:
+            self.queue.release(message['id'], message['reservation_id'],
+                               self.timeout or 60)
+        except Exception:
+            log.exception("Failed to release message %s", message['id'])
+        return True
+
+    def _done(self, message):
+        if self.dedup is not None:
+            self.dedup.commit(message)
+        self._acker.add(message)
+
+    def _release(self, message):
+        if self.dedup is not None:
+            self.dedup.abort(message)
+        try:
+            self.queue.release(message['id'], message['reservation_id'])
+        except Exception:
+            log.exception("Failed to release message %s", message['id'])
+
+    def _finish(self):
+        for thread in self._threads[1:]:
+            thread.join()
+        self._acker.close()
+        self._stopped.set()
+
+
+_process_handler = None
+# Shared memory blocks attached in a worker process, by name.
+_process_blocks = collections.OrderedDict()
+
+# A chunk of bodies in shared memory: their count, then their lengths.
+_CHUNK_COUNT = struct.Struct('>I')
+
+
+def _init_process(handler):
+    global _process_handler
+    _process_handler = handler
+
+
+def _attach_block(name):
+    """Returns the shared memory block of a dispatching thread, attached
+    once per worker process.
+    """
+    block = _process_blocks.pop(name, None)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+    _process_blocks[name] = block
+    # Blocks are replaced when they grow; let go of old ones.
+    while len(_process_blocks) > 64:
+        _process_blocks.popitem(last=False)[1].close()
+    return block
+
+
+def _process_chunk(chunk):
+    """Runs the handler of a ProcessConsumer on a chunk of message bodies in
+    a worker process. chunk is the list of bodies, or the name of the shared
+    memory block holding them. Returns a list of (True, result) or (False,
+    error description) pairs.
+    """
+    if isinstance(chunk, list):
+        bodies = chunk
+    else:
+        buf = _attach_block(chunk).buf
+        count, = _CHUNK_COUNT.unpack_from(buf, 0)
+        lengths = struct.unpack_from('>%dI' % count, buf, _CHUNK_COUNT.size)
+        offset = _CHUNK_COUNT.size + 4 * count
+        bodies = []
+        for length in lengths:
+            bodies.append(bytes(buf[offset:offset + length]).decode('utf-8'))
+            offset += length
+    results = []
+    for body in bodies:
+        try:
+            results.append((True, _process_handler(body)))
+        except Exception as e:
+            # Exceptions are not always picklable; describe them instead.
+            results.append((False, '%s: %s' % (type(e).__name__, e)))
+    return results
+
+
+class ProcessConsumer(Consumer):
+    """Processes the messages of a queue with a pool of worker processes,
+    for handlers that are CPU bound.
+
+    Reserving and deleting messages happens in this process, as in
+    Consumer, over a single set of connections. Message bodies are handed
+    to the worker processes in chunks through shared memory, where
+    multiprocessing.shared_memory is available, and handler is called
+    with each body there. Its return value is passed back to callback.
+
+    Each dispatching thread writes its chunks to one long-lived shared
+    memory block, which worker processes attach once, so that a chunk
+    costs no system calls and only its bodies are copied, without the
+    pickling of a list of strings. If a worker process dies, e.g. killed
+    for running out of memory, the pool is replaced and the messages it
+    was processing are released.
+    """
+
+    def __init__(self, queue, handler, processes=None, chunk_size=10,
+                 prefetch=None, wait=30, timeout=None, ack_batch=100,
+                 ack_interval=0.5, tuner=None, dedup=None, callback=None,
+                 mp_context=None):
+        """Arguments:
+        queue -- The Queue to consume.
+        handler -- A picklable callable, called with each message body in
+                   a worker process.
+        processes -- The number of worker processes. Defaults to the number
+                     of CPUs.
+        chunk_size -- The maximum number of messages handed to a worker
+                      process at once.
+        callback -- Optional. A callable, called in this process with each
+                    message dict and the value handler returned for it.
+        mp_context -- The multiprocessing context of the worker processes.
+                      Defaults to 'forkserver' where available, as forking
+                      a process while other threads run may deadlock.
+
+        The other arguments are those of Consumer.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        Consumer.__init__(self, queue, handler, concurrency=processes,
+                          prefetch=prefetch or 2 * processes * chunk_size,
+                          wait=wait, timeout=timeout, ack_batch=ack_batch,
+                          ack_interval=ack_interval, tuner=tuner, dedup=dedup)
+        self.chunk_size = chunk_size
+        self.callback = callback
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else None)
+        self.mp_context = mp_context
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def start(self):
+        """Starts the worker processes, then reserving and processing
+        messages in the background.
+        """
+        self._pool = self._new_pool()
+        return Consumer.start(self)
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.concurrency,
+                                   mp_context=self.mp_context,
+                                   initializer=_init_process,
+                                   initargs=(self.handler,))
+
+    def _replace_pool(self, broken):
+        with self._pool_lock:
+            if self._pool is broken:
+                log.error("A worker process of the consumer of %s died; "
+                          "starting new ones", self.queue.name)
+                broken.shutdown(wait=False)
+                self._pool = self._new_pool()
+
+    def _work(self):
+        block = None  # the shared memory block of this thread
+        try:
+            while True:
+                message = self._buffer.get()
+                if message is None:
+                    return
+                messages = [message]
+                while len(messages) < self.chunk_size:
+                    try:
+                        message = self._buffer.get_nowait()
+                    except _queue.Empty:
+                        break
+                    if message is None:
+                        # Leave the stop signal for after this chunk.
+                        self._buffer.put(None)
+                        break
+                    messages.append(message)
+                for message in messages:
+                    self._slots.release()
+                messages = [m for m in messages if not self._duplicate(m)]
+                if messages:
+                    block = self._process(messages, block)
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    def _process(self, messages, block):
+        """Processes a chunk of messages in a worker process and returns the
+        shared memory block to use for the next chunk.
+        """
+        started = _clock()
+        pool = self._pool
+        try:
+            if shared_memory is None:
+                chunk = [m['body'] for m in messages]
+            else:
+                block = self._write_chunk(messages, block)
+                chunk = block.name
+            results = pool.submit(_process_chunk, chunk).result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._replace_pool(pool)
+            else:
+                log.exception("Failed to process %d messages from %s",
+                              len(messages), self.queue.name)
+            results = [(False, '%s: %s' % (type(e).__name__, e))] * len(messages)
+        elapsed = _clock() - started
+        for message, (ok, result) in zip(messages, results):
+            if not ok:
+                log.error("Handler failed on message %s from %s: %s",
+                          message['id'], self.queue.name, result)
+                self._release(message)
+                continue
+            self._done(message)
+            if self.callback is not None:
+                try:
+                    self.callback(message, result)
+                except Exception:
+                    log.exception("Callback failed on message %s from %s",
+                                  message['id'], self.queue.name)
+            if self.tuner is not None:
+                self.tuner.processed(elapsed)
+        return block
+
+    def _write_chunk(self, messages, block):
+        """Writes the bodies of messages to block, or to a new block if it
+        is too small, and returns the block.
+        """
+        bodies = [m['body'].encode('utf-8') for m in messages]
+        header = _CHUNK_COUNT.size + 4 * len(bodies)
+        size = header + sum(len(b) for b in bodies)
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            # Grow by doubling, so that a few large chunks settle the size.
+            block = shared_memory.SharedMemory(
+                create=True, size=max(size, 2 * (block.size if block else 0), 65536))
+        _CHUNK_COUNT.pack_into(block.buf, 0, len(bodies))
+        struct.pack_into('>%dI' % len(bodies), block.buf, _CHUNK_COUNT.size,
+                         *[len(b) for b in bodies])
+        offset = header
+        for body in bodies:
+            block.buf[offset:offset + len(body)] = body
+            offset += len(body)
+        return block
+
+    def _finish(self):
+        for thread in self._threads[1:]:
+            thread.join()
+        with self._pool_lock:
+            self._pool.shutdown()
+        Consumer._finish(self)
+
+
+class Deduplicator(object):
+    """Remembers processed messages for ttl seconds, so that a message
+    redelivered after its reservation expired, or posted twice with the
+    same dedup_key, is processed once.
+
+    Messages are identified by their dedup_key if they have one, and by
+    their id otherwise. Call begin() before processing a message; it
+    returns False for duplicates. Then call commit() once the message was
+    processed, or abort() if processing failed, so that it can be
+    processed again. Consumer does this given dedup=.
+
+    Only 64-bit digests of the keys are kept, in an LRU of at most max_size
+    entries, or with path, in an SQLite database that processes of the host
+    share.
+    """
+
+    def __init__(self, ttl=3600, max_size=100000, path=None, lease=300):
+        """Keyword arguments:
+        ttl -- Seconds a processed message is remembered.
+        max_size -- The maximum number of messages remembered in memory.
+        path -- Optional. The path of an SQLite database to remember
+                messages in instead.
+        lease -- Seconds a message being processed is held back from other
+                 consumers, should the process die before commit() or
+                 abort().
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.lease = lease
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._seen = collections.OrderedDict()  # digest -> (expiry time, done)
+        self._local = threading.local()
+        self._commits = 0
+        if path is not None:
+            if sqlite3 is None:
+                raise ValueError('An on-disk index needs sqlite3.')
+            self._db().execute('CREATE TABLE IF NOT EXISTS seen '
+                               '(digest INTEGER PRIMARY KEY, expires REAL, '
+                               'done INTEGER)')
+
+    def begin(self, message):
+        """Returns True and holds message back from other consumers until
+        commit() or abort(), unless it is a duplicate. Returns False if it
+        was processed already, and None if it is being processed, in which
+        case the attempt in progress may still fail and abort().
+        """
+        digest = self._digest(message)
+        now = time.time()
+        if self.path is not None:
+            db = self._db()
+            with db:
+                db.execute('DELETE FROM seen WHERE digest = ? AND expires < ?',
+                           (digest, now))
+                new = db.execute('INSERT OR IGNORE INTO seen VALUES (?, ?, 0)',
+                                 (digest, now + self.lease)).rowcount == 1
+                if not new:
+                    done = db.execute('SELECT done FROM seen WHERE digest = ?',
+                                      (digest,)).fetchone()[0]
+        else:
+            with self._lock:
+                expires, done = self._seen.get(digest, (0, False))
+                new = expires < now
+                if new:
+                    self._remember(digest, now + self.lease, False)
+        if new:
+            return True
+        self.duplicates += 1
+        return False if done else None
+
+    def commit(self, message):
+        """Remembers that message was processed."""
+        digest = self._digest(message)
+        expires = time.time() + self.ttl
+        if self.path is None:
+            with self._lock:
+                self._remember(digest, expires, True)
+            return
+        db = self._db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO seen VALUES (?, ?, 1)', (digest, expires))
+            self._commits += 1
+            if self._commits % 1000 == 0:
+                db.execute('DELETE FROM seen WHERE expires < ?', (time.time(),))
+
+    def abort(self, message):
+        """Forgets a message whose processing failed."""
+        digest = self._digest(message)
+        if self.path is None:
+            with self._lock:
+                self._seen.pop(digest, None)
+            return
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM seen WHERE digest = ?', (digest,))
+
+    def _digest(self, message):
+        key = message.get('dedup_key')
+        key = 'id:%s' % message['id'] if key is None else 'key:%s' % key
+        return struct.unpack('>q', hashlib.sha1(key.encode('utf-8')).digest()[:8])[0]
+
+    def _remember(self, digest, expires, done):
+        self._seen[digest] = (expires, done)
+        if hasattr(self._seen, 'move_to_end'):
+            self._seen.move_to_end(digest)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    def _db(self):
+        # SQLite connections can not be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+        return db
+
+
+class ReserveTuner(object):
+    """Chooses the max, wait and timeout arguments of Queue.reserve from
+    observed traffic, for a Consumer or a loop calling reserve.
+
+    max doubles while reserves come back full, and otherwise follows the
+    number of messages a reserve returns. wait is 0 while reserves rarely
+    come back empty, and otherwise long enough for max messages to arrive
+    at the observed arrival rate, up to max_wait. timeout covers the
+    percentile of handler latency times factor, plus the time the messages
+    wait for a worker.
+    """
+
+    def __init__(self, max_messages=100, max_wait=30, min_timeout=30,
+                 max_timeout=86400, percentile=0.99, factor=2.0, window=1000,
+                 smoothing=0.2):
+        """Keyword arguments:
+        max_messages -- The largest max chosen. Max is 100.
+        max_wait -- The longest wait chosen, in seconds. Max is 30 seconds.
+        min_timeout -- The shortest timeout chosen, in seconds.
+        max_timeout -- The longest timeout chosen, in seconds.
+        percentile -- The percentile of handler latency timeout is based on.
+        factor -- The multiple of that latency timeout covers.
+        window -- The number of recent handler latencies kept.
+        smoothing -- The weight of the latest reserve in the moving
+                     averages of messages per reserve, empty reserves and
+                     arrival rate.
+        """
+        self.max_messages = max_messages
+        self.max_wait = max_wait
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.factor = factor
+        self.smoothing = smoothing
+        self.reserves = 0
+
+        self._lock = threading.Lock()
+        self._max = 1
+        self._received = 0.0
+        self._empty = 0.0
+        self._rate = 0.0
+        self._last_reserve = None
+        self._latencies = collections.deque(maxlen=window)
+        self._decision = {}
+
+    def params(self, backlog=0, concurrency=1):
+        """Returns a dict of the max, wait and timeout arguments for the
+        next reserve. timeout is None until a handler latency was observed.
+
+        Keyword arguments:
+        backlog -- The number of reserved messages still waiting for a worker.
+        concurrency -- The number of workers processing the messages.
+        """
+        with self._lock:
+            n = self._max
+            if self._empty < 0.05 and self.reserves:
+                wait = 0
+            elif self._rate > 0:
+                wait = min(self.max_wait, int(math.ceil(n / self._rate)))
+            else:
+                wait = self.max_wait
+
+            timeout = None
+            latency = None
+            mean = None
+            if self._latencies:
+                latencies = sorted(self._latencies)
+                latency = latencies[min(len(latencies) - 1,
+                                        int(len(latencies) * self.percentile))]
+                mean = sum(latencies) / len(latencies)
+                queued = (backlog + n) * mean / max(1, concurrency)
+                timeout = int(math.ceil(latency * self.factor + queued))
+                timeout = max(self.min_timeout, min(self.max_timeout, timeout))
+
+            self._decision = {
+                'max': n,
+                'wait': wait,
+                'timeout': timeout,
+                'reserves': self.reserves,
+                'messages_per_reserve': self._received,
+                'empty_ratio': self._empty,
+                'arrival_rate': self._rate,
+                'latency_mean': mean,
+                'latency_percentile': latency,
+            }
+            return {'max': n, 'wait': wait, 'timeout': timeout}
+
+    def reserved(self, requested, received):
+        """Records that a reserve for requested messages returned received."""
+        now = _clock()
+        with self._lock:
+            a = self.smoothing
+            self.reserves += 1
+            self._received += a * (received - self._received)
+            self._empty += a * ((received == 0) - self._empty)
+            if self._last_reserve is not None and now > self._last_reserve:
+                self._rate += a * (received / (now - self._last_reserve) - self._rate)
+            self._last_reserve = now
+            if received >= requested:
+                self._max = min(self.max_messages, self._max * 2)
+            else:
+                self._max = max(1, min(self.max_messages,
+                                       int(math.ceil(self._received * 1.5))))
+
+    def processed(self, seconds):
+        """Records that a handler took seconds to process a message."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def decisions(self):
+        """Returns a dict of the arguments chosen last by params() and the
+        observations they were based on.
+        """
+        with self._lock:
+            return dict(self._decision)
+
+
+class _QueueState(object):
+    __slots__ = ('queue', 'weight', 'deficit', 'ready_at', 'empty_polls',
+                 'polling', 'acker')
+
+    def __init__(self, queue, weight):
+        self.queue = queue
+        self.weight = weight
+        self.deficit = 0
+        self.ready_at = 0
+        self.empty_polls = 0
+        self.polling = False
+        self.acker = None
+
+
+class MultiQueueConsumer(object):
+    """Reserves messages from many queues into a single bounded stream.
+
+    A few poller threads share all queues. Queues are picked by weighted
+    deficit round robin: on each turn a queue earns weight * quantum
+    messages of credit, and a reservation asks for up to the credit the
+    queue has. A queue that returned no messages is not polled again for an
+    exponentially growing backoff, so that empty queues cost few requests
+    while busy ones are polled back to back.
+
+        consumer = MultiQueueConsumer(ironmq, ['tenant1', 'tenant2'],
+                                      weights={'tenant1': 3}).start()
+        for queue_name, message in consumer:
+            process(message)
+            consumer.ack(queue_name, message)
+    """
+
+    def __init__(self, mq, queue_names, weights=None, pollers=4, prefetch=100,
+                 quantum=10, timeout=None, min_backoff=0.5, max_backoff=30,
+                 ack_batch=100, ack_interval=0.5):
+        """Arguments:
+        mq -- An instance of IronMQ.
+        queue_names -- The names of the queues to consume.
+        weights -- A dict of queue names to their weight. Defaults to 1.
+        pollers -- The number of reservations in flight at once.
+        prefetch -- The maximum number of reserved messages waiting to be
+                    taken from the stream.
+        quantum -- The credit, in messages, a queue of weight 1 earns per turn.
+        timeout -- Reservation timeout in seconds. If not set, value from
+                   queue is used.
+        min_backoff, max_backoff -- Bounds of the delay before polling an
+                                    empty queue again, in seconds.
+        ack_batch -- The maximum number of messages deleted per request.
+        ack_interval -- The longest an acknowledged message waits to be
+                        deleted, in seconds.
+        """
+        weights = weights or {}
+        self._states = [_QueueState(mq.queue(name), weights.get(name, 1))
+                        for name in queue_names]
+        self._by_name = dict((s.queue.name, s) for s in self._states)
+        self.pollers = pollers
+        self.prefetch = prefetch
+        self.quantum = quantum
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+
+        self._cond = threading.Condition()
+        self._buffer = collections.deque()
+        self._free = prefetch
+        self._cursor = 0
+        self._stopping = False
+        self._running = 0
+        self._threads = []
+
+    def start(self):
+        """Starts reserving messages in the background."""
+        self._running = self.pollers
+        for i in range(self.pollers):
+            thread = threading.Thread(target=self._poll,
+                                      name='iron_mq-multi-poller-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def get(self, timeout=None):
+        """Returns the next (queue name, message) pair, waiting up to
+        timeout seconds for one. Returns None on timeout, or once the
+        consumer is stopped and all reserved messages were taken.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._buffer:
+                if self._stopping and not self._running:
+                    return None
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            item = self._buffer.popleft()
+            self._free += 1
+            self._cond.notify_all()
+            return item
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def ack(self, queue_name, message):
+        """Deletes a processed message from the queue it was reserved from.
+        Deletes are sent in batches per queue.
+        """
+        state = self._by_name[queue_name]
+        with self._cond:
+            if state.acker is None:
+                state.acker = _Acker(state.queue, self.ack_batch, self.ack_interval)
+        state.acker.add(message)
+
+    def release(self, queue_name, message, delay=0):
+        """Releases a message back on to the queue it was reserved from."""
+        return self._by_name[queue_name].queue.release(
+            message['id'], message['reservation_id'], delay)
+
+    def stop(self):
+        """Stops reserving messages. Messages already reserved can still be
+        taken from the stream.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def close(self):
+        """Stops reserving messages, releases the ones not taken from the
+        stream and deletes acknowledged ones.
+        """
+        self.stop()
+        for thread in self._threads:
+            thread.join()
+        with self._cond:
+            leftover = list(self._buffer)
+            self._buffer.clear()
+        for queue_name, message in leftover:
+            try:
+                self.release(queue_name, message)
+            except Exception:
+                log.exception("Failed to release message %s", message['id'])
+        for state in self._states:
+            if state.acker is not None:
+                state.acker.close()
+
+    def stats(self):
+        """Returns a dict of queue names to their scheduling state."""
+        now = time.time()
+        with self._cond:
+            return dict((s.queue.name, {'weight': s.weight,
+                                        'deficit': s.deficit,
+                                        'empty_polls': s.empty_polls,
+                                        'backoff': max(0, s.ready_at - now)})
+                        for s in self._states)
+
+    def _schedule(self):
+        while not self._stopping:
+            now = time.time()
+            if self._free > 0:
+                for i in range(len(self._states)):
+                    state = self._states[self._cursor]
+                    self._cursor = (self._cursor + 1) % len(self._states)
+                    if state.polling or state.ready_at > now:
+                        continue
+                    credit = state.weight * self.quantum
+                    state.deficit = min(state.deficit + credit, max(credit, 100))
+                    n = min(int(state.deficit), 100, self._free)
+                    if n >= 1:
+                        state.deficit -= n
+                        return state, n
+            waiting = [s.ready_at for s in self._states
+                       if not s.polling and s.ready_at > now]
+            self._cond.wait(min(waiting) - now if waiting else None)
+        return None, 0
+
+    def _poll(self):
+        try:
+            while True:
+                with self._cond:
+                    state, n = self._schedule()
+                    if state is None:
+                        return
+                    state.polling = True
+                    self._free -= n
+                try:
+                    messages = state.queue.reserve(max=n, timeout=self.timeout)['messages']
+                except Exception:
+                    log.exception("Failed to reserve messages from %s",
+                                  state.queue.name)
+                    messages = []
+                with self._cond:
+                    state.polling = False
+                    self._free += n - len(messages)
+                    if messages:
+                        state.empty_polls = 0
+                        state.ready_at = 0
+                        self._buffer.extend((state.queue.name, m) for m in messages)
+                    else:
+                        state.deficit = 0
+                        state.ready_at = time.time() + min(
+                            self.max_backoff,
+                            self.min_backoff * 2 ** state.empty_polls)
+                        state.empty_polls += 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+
+class _Lease(object):
+    __slots__ = ('message_id', 'reservation_id', 'timeout', 'due',
+                 'touching', 'closed')
+
+    def __init__(self, message_id, reservation_id, timeout, due):
+        self.message_id = message_id
+        self.reservation_id = reservation_id
+        self.timeout = timeout
+        self.due = due
+        self.touching = False
+        self.closed = False
+
+
+class LeaseManager(object):
+    """Renews the reservations of messages until they are deleted or
+    released.
+
+    A single background thread keeps the renewal deadlines of all tracked
+    messages in a heap. Whenever it wakes up, it touches every message whose
+    reservation expires within the margin, so that renewals due around the
+    same time go out together. The reservation id each touch returns
+    replaces the previous one, and delete(), delete_multiple() and release()
+    use the latest id.
+    """
+
+    def __init__(self, queue, timeout=None, margin=None, max_workers=4):
+        """Arguments:
+        queue -- The Queue messages were reserved from.
+        timeout -- The reservation timeout in seconds, as passed to
+                   Queue.reserve. If not set, value from queue is used.
+        margin -- Touch messages when their reservation expires within this
+                  many seconds. Defaults to a third of the timeout.
+        max_workers -- The number of touch requests sent concurrently.
+        """
+        self.queue = queue
+        self.timeout = timeout
+        self.margin = margin
+
+        self._leases = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread = threading.Thread(target=self._run,
+                                        name='iron_mq-leases-%s' % queue.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def track(self, messages, timeout=None):
+        """Starts renewing the reservations of messages.
+
+        Arguments:
+        messages -- Response to message reserving, or a list of reserved messages.
+        timeout -- The timeout messages were reserved with, if it differs
+                   from the one of the manager.
+        """
+        if isinstance(messages, dict):
+            messages = messages['messages']
+        timeout = timeout or self._default_timeout()
+        now = time.time()
+        with self._cond:
+            for message in messages:
+                lease = _Lease(message['id'], message['reservation_id'],
+                               timeout, now + timeout - self._margin(timeout))
+                self._leases[lease.message_id] = lease
+                heapq.heappush(self._heap, (lease.due, next(self._counter), lease))
+            self._cond.notify()
+
+    def untrack(self, message_id):
+        """Stops renewing a message and returns its latest reservation id."""
+        with self._cond:
+            lease = self._leases.pop(message_id, None)
+            if lease is None:
+                return None
+            lease.closed = True
+            while lease.touching:
+                self._cond.wait()
+            return lease.reservation_id
+
+    def reservation_id(self, message_id):
+        """Returns the latest reservation id of a tracked message."""
+        with self._cond:
+            lease = self._leases.get(message_id)
+            while lease is not None and lease.touching:
+                self._cond.wait()
+            return lease.reservation_id if lease is not None else None
+
+    def delete(self, message_id):
+        """Deletes a tracked message using its latest reservation id."""
+        return self.queue.delete(message_id, self.untrack(message_id))
+
+    def delete_multiple(self, ids):
+        """Deletes tracked messages using their latest reservation ids.
+
+        Arguments:
+        ids -- A list of ids of tracked messages.
+        """
+        items = [{'id': id, 'reservation_id': self.untrack(id)} for id in ids]
+        return self.queue.delete_multiple(messages={'messages': items})
+
+    def release(self, message_id, delay=0):
+        """Releases a tracked message using its latest reservation id."""
+        return self.queue.release(message_id, self.untrack(message_id), delay)
+
+    def close(self):
+        """Stops renewing all messages."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _default_timeout(self):
+        if self.timeout is None:
+            self.timeout = self.queue.info().get('message_timeout', 60)
+        return self.timeout
+
+    def _margin(self, timeout):
+        if self.margin is not None:
+            return min(self.margin, timeout)
+        return timeout / 3.0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.time()
+                    while self._heap and self._heap[0][2].closed:
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if self._closed:
+                    return
+                # Renew everything that would fall due before the next
+                # wakeup anyway, in one pass.
+                horizon = now + self._margin(self._heap[0][2].timeout) / 2
+                due = []
+                while self._heap and self._heap[0][0] <= horizon:
+                    lease = heapq.heappop(self._heap)[2]
+                    if not lease.closed:
+                        lease.touching = True
+                        due.append(lease)
+            for lease in due:
+                self._executor.submit(self._touch, lease)
+
+    def _touch(self, lease):
+        try:
+            response = self.queue.touch(lease.message_id, lease.reservation_id,
+                                        lease.timeout)
+        except Exception:
+            log.exception("Failed to renew reservation of message %s",
+                          lease.message_id)
+            with self._cond:
+                lease.touching = False
+                if self._leases.get(lease.message_id) is lease:
+                    del self._leases[lease.message_id]
+                self._cond.notify_all()
+            return
+        with self._cond:
+            lease.touching = False
+            lease.reservation_id = response['reservation_id']
+            if not lease.closed:
+                lease.due = time.time() + lease.timeout - self._margin(lease.timeout)
+                heapq.heappush(self._heap, (lease.due, next(self._counter), lease))
+            self._cond.notify_all()
+
+
+class MetadataCache(object):
+    """Caches queue details for ttl seconds.
+
+    Concurrent lookups of a queue that is not cached share a single request.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}      # name -> (expires at, info)
+        self._inflight = {}     # name -> Future
+        self._generations = {}  # name -> number of invalidations
+
+    def get(self, name, fetch):
+        """Returns the cached details of a queue, calling fetch() to get
+        them if they are missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            future = self._inflight.get(name)
+            owner = future is None
+            if owner:
+                future = self._inflight[name] = Future()
+                generation = self._generations.get(name, 0)
+        if not owner:
+            return future.result()
+
+        try:
+            info = fetch()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[name]
+            # Details fetched before an invalidation may already be stale.
+            if self._generations.get(name, 0) == generation:
+                self._entries[name] = (time.time() + self.ttl, info)
+        future.set_result(info)
+        return info
+
+    def invalidate(self, name=None):
+        """Drops the cached details of a queue, or of all queues."""
+        with self._lock:
+            if name is not None:
+                names = [name]
+            else:
+                names = set(self._entries) | set(self._inflight)
+            for name in names:
+                self._entries.pop(name, None)
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+
+class JSONCodec(object):
+    """Encodes and decodes JSON with the standard library."""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    """Encodes and decodes JSON with orjson."""
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(object):
+    """Encodes and decodes JSON with ujson."""
+    name = 'ujson'
+
+    def dumps(self, obj):
+        return ujson.dumps(obj)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+def get_codec(codec=None):
+    """Returns a codec object for codec, which is a codec name, None for the
+    standard library or a codec object.
+    """
+    if codec is None or codec == 'json':
+        return JSONCodec()
+    if codec == 'auto':
+        codec = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+        return get_codec(codec)
+    if codec == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed.')
+        return OrjsonCodec()
+    if codec == 'ujson':
+        if ujson is None:
+            raise ValueError('ujson is not installed.')
+        return UjsonCodec()
+    if isinstance(codec, basestring):
+        raise ValueError('Unknown codec: %s' % codec)
+    return codec
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit breaker of its
+    operation is open.
+    """
+
+    def __init__(self, operation, retry_in):
+        Exception.__init__(self, 'Circuit open for %s, retry in %.1f seconds.' %
+                           (operation, retry_in))
+        self.operation = operation
+        self.retry_in = retry_in
+
+
+class RetryPolicy(object):
+    """Decides whether and when failed requests are retried.
+
+    Requests failing with one of statuses or with a connection error are
+    retried with exponential backoff and full jitter, waiting for at least
+    the Retry-After the service asked for. Posting messages is not
+    idempotent, so posts are only retried when the service signals that it
+    did not process them: 429 or 503 responses, or a failure to connect.
+
+    Optionally, each operation (post, reserve, delete, ...) has a circuit
+    breaker. After breaker_threshold consecutive failures, requests for that
+    operation fail immediately with CircuitOpenError for breaker_timeout
+    seconds; then one request is let through, and closes the circuit again
+    if it succeeds.
+    """
+
+    # Operations that must not be sent twice if the first attempt may have
+    # been processed.
+    NON_IDEMPOTENT = frozenset(['post'])
+
+    def __init__(self, max_attempts=6, base_delay=0.5, max_delay=30,
+                 statuses=(429, 503, 504), breaker_threshold=None,
+                 breaker_timeout=30):
+        """Keyword arguments:
+        max_attempts -- The maximum number of attempts per request.
+        base_delay -- The upper bound of the first backoff, in seconds. It
+                      doubles with each attempt.
+        max_delay -- The upper bound of any backoff, in seconds. Requests are
+                     not retried if Retry-After asks for more.
+        statuses -- The HTTP status codes of failed requests to retry.
+        breaker_threshold -- The number of consecutive failures of an
+                             operation that open its circuit. Defaults to
+                             None, which disables circuit breaking.
+        breaker_timeout -- How long a circuit stays open, in seconds.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = frozenset(statuses)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self._lock = threading.Lock()
+        self._failures = {}   # operation -> consecutive failures
+        self._open_until = {} # operation -> time the circuit half-opens
+
+    def delay(self, operation, attempt, response=None, error=None):
+        """Returns the seconds to wait before retrying a failed request, or
+        None if it must not be retried.
+
+        Arguments:
+        operation -- The operation of the request, e.g. 'post'.
+        attempt -- The number of retries done so far.
+        response -- The requests.Response of the failed request, if any.
+        error -- The exception the failed request raised, if any.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if operation in self.NON_IDEMPOTENT:
+            if response is not None and response.status_code not in (429, 503):
+                return None
+            if error is not None and not _not_sent(error):
+                return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after(response) if response is not None else None
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def before(self, operation):
+        """Raises CircuitOpenError if the circuit of operation is open."""
+        if self.breaker_threshold is None:
+            return
+        with self._lock:
+            open_until = self._open_until.get(operation)
+            if open_until is None:
+                return
+            now = time.time()
+            if now < open_until:
+                raise CircuitOpenError(operation, open_until - now)
+            # Half-open: let this request through, hold back the others
+            # until it completes.
+            self._open_until[operation] = now + self.breaker_timeout
+
+    def succeeded(self, operation):
+        if self.breaker_threshold is None:
+            return
+        with self._lock:
+            self._failures.pop(operation, None)
+            self._open_until.pop(operation, None)
+
+    def failed(self, operation):
+        if self.breaker_threshold is None:
+            return
+        with self._lock:
+            failures = self._failures.get(operation, 0) + 1
+            self._failures[operation] = failures
+            if failures >= self.breaker_threshold:
+                self._open_until[operation] = time.time() + self.breaker_timeout
+                log.warning("Circuit opened for %s after %d failures",
+                            operation, failures)
+
+
+def _not_sent(error):
+    # requests raises ConnectionError both when it could not connect and when
+    # the connection dropped mid-request; only the former guarantees that
+    # nothing was sent.
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _not_processed(error):
+    """Returns True if a request that raised error was certainly not
+    processed: it was rejected with a 4xx status or 503, or never sent.
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return 400 <= response.status_code < 500 or response.status_code == 503
+    if isinstance(error, requests.ConnectionError):
+        return _not_sent(error)
+    return False
+
+
+def _rejected(error):
+    """Returns True if a request failed with an error retrying can not fix:
+    a 4xx response other than 408 or 429.
+    """
+    response = getattr(error, 'response', None)
+    if not isinstance(error, requests.HTTPError) or response is None:
+        return False
+    return 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def _operation(method, url):
+    """Returns the operation name and queue name of a request, from its
+    method and URL relative to the project.
+    """
+    parts = url.split('?', 1)[0].split('/')
+    if len(parts) < 2:
+        return 'list_queues', None
+    name = parts[1]
+    route = (method,) + tuple(p if i % 2 == 0 else '*'
+                              for i, p in enumerate(parts[2:]))
+    return _OPERATIONS.get(route, method.lower()), name
+
+
+_OPERATIONS = {
+    ('GET',): 'info',
+    ('PUT',): 'create_queue',
+    ('PATCH',): 'update_queue',
+    ('DELETE',): 'delete_queue',
+    ('POST', 'messages'): 'post',
+    ('GET', 'messages'): 'peek',
+    ('DELETE', 'messages'): 'delete_multiple',
+    ('POST', 'reservations'): 'reserve',
+    ('GET', 'messages', '*'): 'get_message',
+    ('DELETE', 'messages', '*'): 'delete',
+    ('POST', 'messages', '*', 'touch'): 'touch',
+    ('POST', 'messages', '*', 'release'): 'release',
+    ('GET', 'messages', '*', 'subscribers'): 'push_statuses',
+    ('POST', 'subscribers'): 'add_subscribers',
+    ('PUT', 'subscribers'): 'replace_subscribers',
+    ('DELETE', 'subscribers'): 'remove_subscribers',
+}
+
+
+class RateLimiter(object):
+    """Limits the rate and the concurrency of the requests of an IronMQ
+    client, to stay under a request quota.
+
+    Requests take a token from a bucket refilled at rate tokens per second
+    and holding at most burst tokens; when the bucket is empty, they wait
+    their turn, so that throughput stays smooth rather than bursty. At most
+    concurrency requests are in flight at once. These limits apply to all
+    requests together; operations holds additional limits for single
+    operations, e.g. {'post': {'rate': 50}, 'reserve': {'concurrency': 4}}.
+
+    With directory, the buckets and concurrency slots are files locked with
+    fcntl.flock, shared by all processes of the host using the same
+    directory and limits. Slots of a process that dies are freed by the
+    operating system.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, operations=None,
+                 directory=None):
+        """Keyword arguments:
+        rate -- The maximum number of requests per second, or None.
+        burst -- The number of requests that may be sent at once after a
+                 quiet period. Defaults to a tenth of rate, and at least 1.
+        concurrency -- The maximum number of requests in flight, or None.
+        operations -- A dict of operation names, as in RequestEvent, to
+                      dicts of rate, burst and concurrency for that
+                      operation.
+        directory -- Optional. A directory to share the limits through with
+                     other processes.
+        """
+        if directory is not None:
+            if fcntl is None:
+                raise ValueError('Sharing limits between processes needs fcntl.')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.directory = directory
+        self._limits = {None: self._limit('all', rate, burst, concurrency)}
+        for operation, limits in (operations or {}).items():
+            self._limits[operation] = self._limit(operation, **limits)
+
+    def _limit(self, name, rate=None, burst=None, concurrency=None):
+        bucket = slots = None
+        if rate is not None:
+            if burst is None:
+                burst = max(1, rate / 10.0)
+            if self.directory is None:
+                bucket = _TokenBucket(rate, burst)
+            else:
+                bucket = _FileTokenBucket(
+                    rate, burst, os.path.join(self.directory, name + '.bucket'))
+        if concurrency is not None:
+            if self.directory is None:
+                slots = threading.BoundedSemaphore(concurrency)
+            else:
+                slots = _FileSlots(concurrency, os.path.join(self.directory, name))
+        return bucket, slots
+
+    def acquire(self, operation):
+        """Blocks until a request for operation may be sent. Returns the
+        seconds waited for a token.
+        """
+        limits = [self._limits[None]]
+        if operation in self._limits:
+            limits.insert(0, self._limits[operation])
+        for bucket, slots in limits:
+            if slots is not None:
+                slots.acquire()
+        delay = 0
+        for bucket, slots in limits:
+            if bucket is not None:
+                delay = max(delay, bucket.take())
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def release(self, operation):
+        """Records that a request for operation has completed."""
+        limits = [self._limits[None]]
+        if operation in self._limits:
+            limits.insert(0, self._limits[operation])
+        for bucket, slots in reversed(limits):
+            if slots is not None:
+                slots.release()
+
+
+class _TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = _clock()
+
+    def take(self):
+        """Takes a token and returns the seconds until it is due. The
+        bucket goes into debt, so that waiting requests are spaced evenly.
+        """
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate) - 1
+            self._updated = now
+            return max(0, -self._tokens / self.rate)
+
+
+class _FileTokenBucket(object):
+    """A _TokenBucket whose state is kept in a file, shared by processes."""
+
+    STATE = struct.Struct('>dd')  # tokens, time.time() of the last update
+
+    def __init__(self, rate, burst, path):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
+
+    def take(self):
+        # flock does not exclude threads sharing the file descriptor.
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                data = os.read(self._fd, self.STATE.size)
+                now = time.time()
+                tokens, updated = self.burst, now
+                if len(data) == self.STATE.size:
+                    tokens, updated = self.STATE.unpack(data)
+                tokens = min(self.burst, tokens + max(0, now - updated) * self.rate) - 1
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self.STATE.pack(tokens, now))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return max(0, -tokens / self.rate)
+
+
+class _FileSlots(object):
+    """A semaphore of count slots shared by processes, each slot a locked
+    file.
+    """
+
+    def __init__(self, count, prefix):
+        self._fds = [os.open('%s.slot%d' % (prefix, i), os.O_RDWR | os.O_CREAT)
+                     for i in range(count)]
+        self._locks = [threading.Lock() for i in range(count)]
+        self._held = threading.local()
+
+    def acquire(self):
+        delay = 0.001
+        while True:
+            for i in random.sample(range(len(self._fds)), len(self._fds)):
+                if not self._locks[i].acquire(False):
+                    continue
+                try:
+                    fcntl.flock(self._fds[i], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    self._locks[i].release()
+                    continue
+                self._held.slots = getattr(self._held, 'slots', []) + [i]
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def release(self):
+        i = self._held.slots.pop()
+        fcntl.flock(self._fds[i], fcntl.LOCK_UN)
+        self._locks[i].release()
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+_local = threading.local()
+
+
+class trace(object):
+    """Context manager tagging the requests made inside it, in the current
+    thread, with a trace id and a span name, which observers receive in
+    RequestEvent. Nested traces keep the trace id of the outermost one.
+
+        with trace('handle-order') as t:
+            queue.post(...)
+            log.info('trace %s', t.trace_id)
+    """
+
+    def __init__(self, name=None, trace_id=None):
+        self.name = name
+        self.trace_id = trace_id
+        self._parent = None
+
+    def __enter__(self):
+        self._parent = getattr(_local, 'trace', None)
+        if self.trace_id is None:
+            if self._parent is not None:
+                self.trace_id = self._parent.trace_id
+            else:
+                self.trace_id = '%032x' % random.getrandbits(128)
+        _local.trace = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.trace = self._parent
+
+
+class RequestEvent(object):
+    """Timings and sizes of a request, passed to the observers of IronMQ
+    once it has completed.
+
+    operation -- The operation, e.g. 'post', 'reserve' or 'delete_multiple'.
+    queue -- The name of the queue, or None.
+    method, url -- The HTTP method and the URL relative to the project.
+    status -- The HTTP status of the last response, or None.
+    error -- The exception the request raised, or None.
+    attempts -- The number of times the request was sent.
+    encode_time -- Seconds spent encoding the request body.
+    request_time -- Seconds spent sending requests and awaiting responses,
+                    in all attempts.
+    decode_time -- Seconds spent decoding the response body.
+    total_time -- Seconds from the start of the request to its completion,
+                  including backoff between attempts.
+    pool_wait_time -- Seconds spent waiting for a free connection, with a
+                      PooledTransport.
+    throttle_time -- Seconds spent waiting for the RateLimiter.
+    bytes_out, bytes_in -- Sizes of the request and response bodies.
+    trace_id, span -- Trace id and name of the enclosing trace, if any.
+    """
+    __slots__ = ('operation', 'queue', 'method', 'url', 'status', 'error',
+                 'attempts', 'encode_time', 'request_time', 'decode_time',
+                 'total_time', 'pool_wait_time', 'throttle_time', 'bytes_out',
+                 'bytes_in', 'trace_id', 'span')
+
+    def __init__(self, method, url, body):
+        self.operation, self.queue = _operation(method, url)
+        self.method = method
+        self.url = url
+        self.status = None
+        self.error = None
+        self.attempts = 0
+        self.encode_time = _take_encode_time()
+        self.request_time = 0.0
+        self.decode_time = 0.0
+        self.total_time = 0.0
+        self.pool_wait_time = 0.0
+        _local.pool_wait_time = 0.0
+        self.throttle_time = 0.0
+        self.bytes_out = len(body) if body else 0
+        self.bytes_in = 0
+        context = getattr(_local, 'trace', None)
+        self.trace_id = context.trace_id if context is not None else None
+        self.span = context.name if context is not None else None
+
+
+def _add_encode_time(seconds):
+    """Charges seconds of encoding to the next request of this thread."""
+    _local.encode_time = getattr(_local, 'encode_time', 0.0) + seconds
+
+
+def _take_encode_time():
+    """Returns and resets the encoding time charged to the next request of
+    this thread. Code that encodes a request body in one thread and sends it
+    from another passes the time over with _add_encode_time().
+    """
+    seconds = getattr(_local, 'encode_time', 0.0)
+    _local.encode_time = 0.0
+    return seconds
+
+
+class _TimedCodec(object):
+    """Wraps a codec to record encoding time for RequestEvent."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.name = getattr(codec, 'name', None)
+
+    def dumps(self, obj):
+        started = _clock()
+        data = self.codec.dumps(obj)
+        _add_encode_time(_clock() - started)
+        return data
+
+    def loads(self, data):
+        return self.codec.loads(data)
+
+
+class MetricsObserver(object):
+    """Request observer aggregating counters and latency histograms per
+    operation and queue, exported in the Prometheus text format.
+
+        metrics = MetricsObserver()
+        ironmq.add_observer(metrics)
+        ...
+        text = metrics.prometheus()
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS, by_queue=True, prefix='iron_mq'):
+        """Keyword arguments:
+        buckets -- Upper bounds of the latency histogram buckets, in seconds.
+        by_queue -- Label metrics with the queue name. Turn off when there
+                    are too many queues.
+        prefix -- The prefix of the metric names.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.by_queue = by_queue
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests = {}   # (operation, queue, status) -> count
+        self._latency = {}    # (operation, queue) -> [bucket counts, sum, count]
+        self._totals = {}     # (operation, queue) -> [encode, decode, out, in]
+
+    def __call__(self, event):
+        queue = event.queue if self.by_queue else None
+        key = (event.operation, queue)
+        status = event.status if event.status is not None else 'error'
+        with self._lock:
+            requests_key = key + (status,)
+            self._requests[requests_key] = self._requests.get(requests_key, 0) + 1
+            latency = self._latency.get(key)
+            if latency is None:
+                latency = self._latency[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if event.total_time <= bound:
+                    latency[0][i] += 1
+            latency[1] += event.total_time
+            latency[2] += 1
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = self._totals[key] = [0.0, 0.0, 0, 0]
+            totals[0] += event.encode_time
+            totals[1] += event.decode_time
+            totals[2] += event.bytes_out
+            totals[3] += event.bytes_in
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append('# HELP %s_requests_total Requests sent to IronMQ.' % p)
+            lines.append('# TYPE %s_requests_total counter' % p)
+            for (operation, queue, status), count in sorted(self._requests.items(), key=str):
+                lines.append('%s_requests_total{%s} %d' % (
+                    p, _labels(operation, queue, status=status), count))
+
+            lines.append('# HELP %s_request_duration_seconds Request latency, '
+                         'including retries.' % p)
+            lines.append('# TYPE %s_request_duration_seconds histogram' % p)
+            for (operation, queue), (counts, total, count) in sorted(self._latency.items(), key=str):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('%s_request_duration_seconds_bucket{%s} %d' % (
+                        p, _labels(operation, queue, le=repr(float(bound))), bucket))
+                lines.append('%s_request_duration_seconds_bucket{%s} %d' % (
+                    p, _labels(operation, queue, le='+Inf'), count))
+                lines.append('%s_request_duration_seconds_sum{%s} %r' % (
+                    p, _labels(operation, queue), total))
+                lines.append('%s_request_duration_seconds_count{%s} %d' % (
+                    p, _labels(operation, queue), count))
+
+            for index, name, help, type in (
+                    (0, 'encode_seconds_total', 'Time spent encoding request bodies.', '%r'),
+                    (1, 'decode_seconds_total', 'Time spent decoding response bodies.', '%r'),
+                    (2, 'sent_bytes_total', 'Size of request bodies.', '%d'),
+                    (3, 'received_bytes_total', 'Size of response bodies.', '%d')):
+                lines.append('# HELP %s_%s %s' % (p, name, help))
+                lines.append('# TYPE %s_%s counter' % (p, name))
+                for (operation, queue), totals in sorted(self._totals.items(), key=str):
+                    lines.append(('%s_%s{%s} ' + type) % (
+                        p, name, _labels(operation, queue), totals[index]))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(operation, queue, **extra):
+    labels = [('operation', operation)]
+    if queue is not None:
+        labels.append(('queue', queue))
+    labels.extend(sorted(extra.items()))
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in labels)
+
+
+class PooledTransport(object):
+    """Sends the requests of an IronMQ client over persistent connections,
+    shared by all its queues and threads.
+
+    HTTP/1.1 connections are kept alive in a pool of up to pool_size
+    connections per host. Connections idle for longer than idle_timeout
+    seconds, which the server may have dropped already, are reconnected
+    instead of reused. With http2=True, requests are multiplexed over
+    HTTP/2 connections by httpx, which must be installed with its http2
+    extra.
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=30, block=True,
+                 timeout=None, http2=False):
+        """Keyword arguments:
+        pool_size -- The maximum number of connections per host.
+        idle_timeout -- Seconds a connection may stay unused before it is
+                        reconnected, or None.
+        block -- If true, requests wait for a free connection when all
+                 pool_size are in use. Otherwise, extra connections are
+                 opened and closed after use.
+        timeout -- Seconds to wait for the server to connect or send data,
+                   or None to wait indefinitely.
+        http2 -- If true, use HTTP/2 through httpx.
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('requests', 'connections', 'reused',
+                                     'evicted', 'wait_time'), 0)
+        self._stats['wait_time'] = 0.0
+
+        if http2:
+            if httpx is None:
+                raise ValueError('HTTP/2 needs httpx to be installed.')
+            limits = httpx.Limits(max_connections=pool_size,
+                                  max_keepalive_connections=pool_size,
+                                  keepalive_expiry=idle_timeout)
+            self._client = httpx.Client(http2=True, limits=limits,
+                                        timeout=timeout)
+            return
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                pool_block=block)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            'http': _pool_class(urllib3.HTTPConnectionPool, self),
+            'https': _pool_class(urllib3.HTTPSConnectionPool, self),
+        }
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def request(self, method, url, body, headers):
+        self._count('requests')
+        if not self.http2:
+            return self._session.request(method, url, data=body or None,
+                                         headers=headers, timeout=self.timeout)
+        try:
+            r = self._client.request(method, url, content=body or None,
+                                     headers=headers)
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e)
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(r.headers)
+        response.reason = r.reason_phrase
+        response.url = url
+        response._content = r.content
+        return response
+
+    def stats(self):
+        """Returns a dict of the number of requests sent, connections
+        opened, connections reused and connections evicted for being idle,
+        and the seconds spent waiting for a free connection. Only requests
+        are counted with HTTP/2.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """Closes all connections."""
+        if self.http2:
+            self._client.close()
+        else:
+            self._session.close()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+
+def _pool_class(base, transport):
+    """Returns a subclass of a urllib3 connection pool class that evicts
+    idle connections and counts them in the stats of transport.
+    """
+
+    class Pool(base):
+        def _new_conn(self):
+            transport._count('connections')
+            return base._new_conn(self)
+
+        def _get_conn(self, timeout=None):
+            started = _clock()
+            conn = base._get_conn(self, timeout)
+            now = _clock()
+            transport._count('wait_time', now - started)
+            _local.pool_wait_time = getattr(_local, 'pool_wait_time', 0.0) + now - started
+            idle_since = getattr(conn, 'iron_mq_idle_since', None)
+            if idle_since is not None:
+                if (transport.idle_timeout is not None and
+                        now - idle_since > transport.idle_timeout):
+                    # Reconnects on the next request.
+                    conn.close()
+                    transport._count('evicted')
+                    transport._count('connections')
+                else:
+                    transport._count('reused')
+            return conn
+
+        def _put_conn(self, conn):
+            if conn is not None:
+                conn.iron_mq_idle_since = _clock()
+            base._put_conn(self, conn)
+
+    return Pool
+
+
+class _IronClient(iron_core.IronClient):
+    transport = None
+    codec = JSONCodec()
+    retry_policy = RetryPolicy()
+    rate_limiter = None
+    observers = ()
+
+    def request(self, url, method, body="", headers={}, retry=True, raw=False):
+        """Execute an HTTP request like iron_core.IronClient.request, but
+        decode the response with the codec of the client.
+
+        Keyword arguments:
+        raw -- If true, the body of the result is the undecoded response
+               content. Defaults to False.
+        """
+        if not self.observers:
+            return self._request(url, method, body, headers, retry, raw, None)
+
+        event = RequestEvent(method, url, body)
+        started = _clock()
+        try:
+            return self._request(url, method, body, headers, retry, raw, event)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            event.total_time = _clock() - started
+            event.pool_wait_time = _local.pool_wait_time
+            for observer in self.observers:
+                try:
+                    observer(event)
+                except Exception:
+                    log.exception("Request observer %r failed", observer)
+
+    def _request(self, url, method, body, headers, retry, raw, event):
+        if headers:
+            headers = dict(list(headers.items()) + list(self.headers.items()))
+        else:
+            headers = dict(self.headers)
+        policy = self.retry_policy if retry else None
+        operation = None
+        if policy is not None or self.rate_limiter is not None:
+            operation = _operation(method, url)[0]
+        url = self.base_url + url
+
+        attempt = 0
+        while True:
+            if policy is not None:
+                policy.before(operation)
+            try:
+                r = self._send(url, method, body, headers, operation, event)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if policy is None:
+                    raise
+                policy.failed(operation)
+                delay = policy.delay(operation, attempt, error=e)
+                if delay is None:
+                    raise
+            else:
+                if policy is None:
+                    break
+                if r.status_code not in policy.statuses:
+                    policy.succeeded(operation)
+                    break
+                policy.failed(operation)
+                delay = policy.delay(operation, attempt, response=r)
+                if delay is None:
+                    break
+            time.sleep(delay)
+            attempt += 1
+
+        r.raise_for_status()
+
+        result = {}
+        contentType = r.headers.get("Content-Type") or "text/plain"
+        contentType = contentType.split(";")[0]
+        if event is not None:
+            event.bytes_in = len(r.content)
+            decoding = _clock()
+        if raw:
+            result["body"] = r.content
+        elif contentType.lower() == "application/json":
+            try:
+                result["body"] = self.codec.loads(r.content)
+            except ValueError:
+                result["body"] = r.text
+        else:
+            result["body"] = r.text
+        if event is not None:
+            event.decode_time = _clock() - decoding
+        result["status"] = r.status_code
+        result["resp"] = r
+        result["content-type"] = contentType
+        return result
+
+    def _send(self, url, method, body, headers, operation, event):
+        limiter = self.rate_limiter
+        if limiter is not None:
+            waited = limiter.acquire(operation)
+            if event is not None:
+                event.throttle_time += waited
+        try:
+            if event is None:
+                return self._doRequest(url, method, body, headers)
+            event.attempts += 1
+            sent = _clock()
+            try:
+                r = self._doRequest(url, method, body, headers)
+            finally:
+                event.request_time += _clock() - sent
+            event.status = r.status_code
+            return r
+        finally:
+            if limiter is not None:
+                limiter.release(operation)
+
+    def _doRequest(self, url, method, body="", headers={}):
+        if self.transport is None:
+            return super(_IronClient, self)._doRequest(url, method, body, headers)
+        if self.token or self.keystone:
+            headers["Authorization"] = "OAuth %s" % self.token_provider.getToken()
+        return self.transport.request(method, url, body, headers)
+
+
+class QueueChange(object):
+    """The change IronMQ.provision() made, or would make, to a queue.
+
+    name -- The name of the queue.
+    action -- 'create', 'update' or 'delete', or None if the queue is as
+              specified.
+    changes -- A dict of the options that differ to their current and
+               specified values, with 'subscribers' for push subscribers.
+    options -- The options sent to create or update the queue.
+    subscribers -- The push subscribers to replace those of the queue
+                   with, or None.
+    error -- The exception requesting the queue details, or applying the
+             change, raised, or None.
+    """
+
+    def __init__(self, name, action=None):
+        self.name = name
+        self.action = action
+        self.changes = {}
+        self.options = {}
+        self.subscribers = None
+        self.error = None
+
+    @property
+    def ok(self):
+        """True if the change was applied, or none was needed."""
+        return self.error is None
+
+    def __repr__(self):
+        return '<QueueChange %s %s>' % (self.name, self.action)
+
+
+def _queue_change(name, spec, info):
+    """Returns the QueueChange from queue details info, or None for a
+    missing queue, to the options of spec, or None to delete the queue.
+    """
+    if spec is None:
+        return QueueChange(name, 'delete' if info is not None else None)
+    if info is None:
+        change = QueueChange(name, 'create')
+        change.options = spec
+        change.changes = dict((k, (None, v)) for k, v in spec.items())
+        return change
+
+    change = QueueChange(name)
+    for key, value in spec.items():
+        if key != 'push' and info.get(key) != value:
+            change.options[key] = value
+            change.changes[key] = (info.get(key), value)
+    push = dict(spec.get('push') or {})
+    current_push = info.get('push') or {}
+    subscribers = push.pop('subscribers', None)
+    for key, value in push.items():
+        if current_push.get(key) != value:
+            change.options.setdefault('push', {})[key] = value
+            change.changes['push.' + key] = (current_push.get(key), value)
+    if subscribers is not None:
+        current = dict((s['name'], s) for s in current_push.get('subscribers') or [])
+        if (len(current) != len(subscribers) or
+                any(s['name'] not in current or
+                    any(current[s['name']].get(k) != v for k, v in s.items())
+                    for s in subscribers)):
+            change.subscribers = subscribers
+            change.changes['subscribers'] = (list(current.values()), subscribers)
+    if change.changes:
+        change.action = 'update'
+    return change
+
+
+class IronMQ(object):
+    NAME = 'iron_mq_python'
+    VERSION = '0.9'
+    API_VERSION = 3
+    client = None
+    name = None
+    cache = None
+
+    def __init__(self, name=None, transport=None, cache_ttl=None, codec=None,
+                 retry_policy=None, rate_limiter=None, **kwargs):
+        """Prepare a configured instance of the API wrapper and return it.
+
+        Keyword arguments:
+        transport -- An object sending the HTTP requests in place of the
+                     requests library. Its request(method, url, body, headers)
+                     method must return a requests.Response. See
+                     iron_mq_fake.FakeIronMQ for an example.
+        cache_ttl -- Cache queue details for this many seconds. Queue.info(),
+                     size(), id() and total_messages() then share a request.
+                     Defaults to None, which disables caching.
+        codec -- The JSON codec used for request and response bodies: 'json'
+                 (the default), 'orjson', 'ujson', 'auto' for the fastest one
+                 installed, or an object with dumps() and loads() methods.
+        retry_policy -- The RetryPolicy deciding which failed requests are
+                        retried. Defaults to RetryPolicy().
+        rate_limiter -- Optional. A RateLimiter limiting the rate and
+                        concurrency of requests, retries included.
+
+        Other keyword arguments are passed directly to iron_core_python;
+        consult its documentation for a full list and possible values."""
+        if name is not None:
+            self.name = name
+        kwargs['api_version'] = kwargs.get('api_version') or IronMQ.API_VERSION
+
+        self.client = _IronClient(name=IronMQ.NAME,
+                version=IronMQ.VERSION, product='iron_mq', **kwargs)
+        self.client.transport = transport
+        self.client.codec = get_codec(codec)
+        self.client.retry_policy = retry_policy or RetryPolicy()
+        self.client.rate_limiter = rate_limiter
+        if cache_ttl is not None:
+            self.cache = MetadataCache(cache_ttl)
+
+
+    def queues(self, page=None, per_page=None, previous=None, prefix=None):
+        """Execute an HTTP request to get a list of queues and return it.
+
+        Keyword arguments:
+        page -- The 0-based page to get queues from. Defaults to None, which
+                omits the parameter.
+        """
+        options = {}
+        if page is not None:
+            raise Exception('page param is deprecated!')
+        if per_page is not None:
+            options['per_page'] = per_page
+        if previous is not None:
+            options['previous'] = previous
+        if prefix is not None:
+            options['prefix'] = prefix
+
+        query = urlencode(options)
+        url = 'queues'
+        if query != '':
+            url = "%s?%s" % (url, query)
+        result = self.client.get(url)
+
+        return [queue['name'] for queue in result['body']['queues']]
+
+
+    def iter_queues(self, prefix=None, per_page=100, prefetch=True,
+                    info=False, max_workers=8):
+        """Yields the names of all queues, requesting them page by page.
+
+        Keyword arguments:
+        prefix -- Only list queues whose name starts with prefix.
+        per_page -- The number of queues requested at once. Max is 100.
+        prefetch -- Request the next page while the current one is consumed.
+        info -- Yield queue details, as returned by Queue.info(), instead of
+                names. Details of a page are requested concurrently.
+        max_workers -- The maximum number of concurrent requests.
+        """
+        executor = None
+        if prefetch or info:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            page = self.queues(per_page=per_page, prefix=prefix)
+            while page:
+                last = len(page) < per_page
+                next_page = None
+                if prefetch and not last:
+                    next_page = executor.submit(self.queues, per_page=per_page,
+                                                previous=page[-1], prefix=prefix)
+                if info:
+                    items = executor.map(lambda name: self.queue(name).info(), page)
+                else:
+                    items = page
+                for item in items:
+                    yield item
+                if last:
+                    break
+                if next_page is not None:
+                    page = next_page.result()
+                else:
+                    page = self.queues(per_page=per_page, previous=page[-1],
+                                       prefix=prefix)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+
+    def queue(self, queue_name, compression=None, claim_check=None):
+        """Returns Queue object.
+
+        Arguments:
+        queue_name -- The name of the queue.
+        compression -- Optional. A Compression for message bodies.
+        claim_check -- Optional. A ClaimCheck for large message bodies.
+        """
+        return Queue(self, queue_name, compression=compression,
+                     claim_check=claim_check)
+
+
+    def add_observer(self, observer):
+        """Registers a callable that is called with a RequestEvent after
+        each request of this client, e.g. a MetricsObserver. Observers are
+        called in the thread that made the request.
+        """
+        if not isinstance(self.client.codec, _TimedCodec):
+            self.client.codec = _TimedCodec(self.client.codec)
+        self.client.observers = tuple(self.client.observers) + (observer,)
+
+    def remove_observer(self, observer):
+        """Unregisters an observer added with add_observer()."""
+        observers = tuple(o for o in self.client.observers if o != observer)
+        self.client.observers = observers
+        if not observers and isinstance(self.client.codec, _TimedCodec):
+            self.client.codec = self.client.codec.codec
+
+    def queue_infos(self, queue_names, max_workers=8):
+        """Returns a dict of queue names to queue details, requesting the
+        details of several queues concurrently.
+
+        Arguments:
+        queue_names -- The names of the queues.
+        max_workers -- The maximum number of concurrent requests.
+        """
+        queue_names = list(queue_names)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            infos = executor.map(lambda name: self.queue(name).info(), queue_names)
+            return dict(zip(queue_names, infos))
+        finally:
+            executor.shutdown(wait=False)
+
+
+    def provision(self, spec, delete_missing=False, prefix=None,
+                  max_workers=16, dry_run=False):
+        """Brings queues to the state described by spec, changing only what
+        differs. Current queue details are requested, and changes applied,
+        concurrently. Returns a dict of queue names to QueueChange.
+
+        Arguments:
+        spec -- A dict of queue names to queue options, as for create_queue,
+                e.g. {'orders': {'message_timeout': 120, 'push': {
+                'subscribers': [{'name': 'a', 'url': 'http://...'}]}}}.
+                Options missing from spec are left as they are.
+        delete_missing -- Delete queues that are not in spec. Only queues
+                          whose name starts with prefix are considered, so
+                          prefix is required.
+        prefix -- The prefix of the queues delete_missing applies to.
+        max_workers -- The maximum number of concurrent requests.
+        dry_run -- Only report the changes, without applying them.
+
+        A queue whose details could not be requested is left as it is, with
+        the error in its QueueChange.
+        """
+        if delete_missing and not prefix:
+            raise ValueError('delete_missing needs a prefix, or every queue '
+                             'of the project missing from spec is deleted.')
+        names = list(spec)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            current = dict(zip(names, executor.map(self._current_info, names)))
+            if delete_missing:
+                for name in self.iter_queues(prefix=prefix):
+                    if name not in spec:
+                        current[name] = ({'name': name}, None)
+            changes = {}
+            for name, (info, error) in current.items():
+                if error is None:
+                    changes[name] = _queue_change(name, spec.get(name), info)
+                else:
+                    changes[name] = QueueChange(name)
+                    changes[name].error = error
+            if not dry_run:
+                pending = [c for c in changes.values()
+                           if c.action is not None and c.ok]
+                list(executor.map(self._apply_change, pending))
+        finally:
+            executor.shutdown(wait=False)
+        return changes
+
+    def _current_info(self, queue_name):
+        """Returns the details of a queue, or None if it does not exist, and
+        the error requesting them raised, or None.
+        """
+        try:
+            return self.queue(queue_name)._fetch_info(), None
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None, None
+            return None, e
+        except Exception as e:
+            return None, e
+
+    def _apply_change(self, change):
+        try:
+            queue = self.queue(change.name)
+            if change.action == 'create':
+                self.create_queue(change.name, change.options)
+            elif change.action == 'delete':
+                queue.delete_queue()
+            else:
+                if change.options:
+                    self.update_queue(change.name, change.options)
+                if change.subscribers is not None:
+                    queue.replace_subscribers(*change.subscribers)
+        except Exception as e:
+            change.error = e
+
+
+    def create_queue(self, queue_name, options=None):
+        body = self.client.codec.dumps({})
+        if options is not None:
+            body = self.client.codec.dumps({'queue': options})
+        url = "queues/%s" % queue_name
+        response = self.client.put(url, body=body, headers={'Content-Type': 'application/json'})
+        if self.cache is not None:
+            self.cache.invalidate(queue_name)
+        return response['body']['queue']
+
+
+    def update_queue(self, queue_name, options=None):
+        body = self.client.codec.dumps({})
+        if options is not None:
+            body = self.client.codec.dumps({'queue': options})
+        url = "queues/%s" % queue_name
+        response = self.client.patch(url, body=body,
+                                       headers={'Content-Type': 'application/json'})
+        if self.cache is not None:
+            self.cache.invalidate(queue_name)
+        return response['body']['queue']
+
+
+    def _prepare_subscribers(self, *subscribers):
+        subscrs = [{'url': ss} for ss in subscribers]
+        return {'subscribers': subscrs}
+
+    # DEPRECATED
+
+    def getQueues(self, page=None, project_id=None):
+        return self.queues(page=page)
+
+    def getQueueDetails(self, queue_name, project_id=None):
+        return self.queue(queue_name).info()
+
+    def deleteMessage(self, queue_name, message_id, project_id=None):
+        return self.queue(queue_name).delete(message_id)
+
+    def postMessage(self, queue_name, messages=[], project_id=None):
+        return self.queue(queue_name).post(*messages)
+
+    def getMessage(self, queue_name, max=None, project_id=None):
+        return self.queue(queue_name).get(max=max)
+
+    def clearQueue(self, queue_name, project_id=None):
+        return self.queue(queue_name).clear()
+
+
+class TransferStats(object):
+    """Progress of a transfer().
+
+    moved -- Messages posted to the destination.
+    filtered -- Messages filter rejected.
+    skipped -- Messages a previous run had moved already, according to the
+               checkpoint, and were only deleted from the source.
+    failed -- Messages that could not be moved, and were released.
+    undeleted -- Messages moved, skipped or dropped that could not be
+                 deleted from the source. Without a checkpoint, moved ones
+                 are posted again by the next transfer.
+    elapsed -- Seconds since the transfer started.
+    error -- The exception that stopped the transfer early, or else the
+             last one deleting messages from the source raised, or None.
+    """
+
+    def __init__(self):
+        self.moved = 0
+        self.filtered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.undeleted = 0
+        self.elapsed = 0.0
+        self.error = None
+
+    @property
+    def rate(self):
+        """Messages moved per second."""
+        return self.moved / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return ('<TransferStats moved=%d filtered=%d skipped=%d failed=%d '
+                'undeleted=%d rate=%.1f/s>' % (
+                    self.moved, self.filtered, self.skipped, self.failed,
+                    self.undeleted, self.rate))
+
+
+def transfer(source, destination, max_messages=None, batch=100, concurrency=4,
+             filter=None, transform=None, drop_filtered=False, checkpoint=None,
+             timeout=300, wait=1, progress=None, progress_interval=5):
+    """Moves messages from one queue to another until the source is empty,
+    and returns TransferStats.
+
+    Each of concurrency workers reserves batches of messages, posts them
+    to the destination and, once the post succeeded, has them deleted from
+    the source by a background thread in batches, so that reserving, posting
+    and deleting overlap.
+
+    Arguments:
+    source, destination -- The Queues to move messages from and to.
+    max_messages -- The maximum number of messages to move, or None.
+    batch -- The number of messages reserved and posted at once. Max is 100.
+    concurrency -- The number of batches moved concurrently.
+    filter -- Optional. A callable, called with each reserved message dict,
+              returning False for messages to leave on the source. They
+              stay reserved until the transfer ends, then are released.
+    transform -- Optional. A callable, called with each reserved message
+                 dict, returning the body string or message dict to post.
+                 Without it, or given a body string, the dedup_key of the
+                 message is posted along.
+    drop_filtered -- Delete messages filter rejected instead of releasing
+                     them.
+    checkpoint -- Optional. The path of a file recording the ids of moved
+                  messages. A transfer resumed with the same file deletes
+                  messages that were posted but not deleted before,
+                  without posting them again, and counts messages moved
+                  already towards max_messages.
+    timeout -- The reservation timeout of the messages, in seconds.
+    wait -- Time to long poll for messages before a worker decides the
+            source is empty, in seconds.
+    progress -- Optional. A callable, called with the TransferStats every
+                progress_interval seconds.
+    """
+    stats = TransferStats()
+    started = time.time()
+    lock = threading.Lock()
+    held = []
+    moved_ids = set()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            moved_ids = set(line.strip() for line in f if line.strip())
+    budget = [None if max_messages is None else max_messages - len(moved_ids)]
+    reported = [started]
+    stopping = threading.Event()
+    log_file = open(checkpoint, 'a') if checkpoint is not None else None
+    acker = _Acker(source, batch=batch)
+
+    def take(n):
+        with lock:
+            if budget[0] is None:
+                return n
+            n = min(n, budget[0])
+            budget[0] -= n
+            return n
+
+    def give_back(n):
+        if n and budget[0] is not None:
+            with lock:
+                budget[0] += n
+
+    def count(field, n):
+        with lock:
+            setattr(stats, field, getattr(stats, field) + n)
+
+    def payload(message):
+        new = transform(message) if transform is not None else message['body']
+        if isinstance(new, dict):
+            return new
+        new = {'body': new}
+        if message.get('dedup_key') is not None:
+            new['dedup_key'] = message['dedup_key']
+        return new
+
+    def move(messages):
+        """Posts messages to the destination, skipping and filtering them.
+        On failure, releases the messages that were neither posted, nor
+        deleted or held back by the filter.
+        """
+        out, moving, settled = [], [], set()
+        try:
+            for message in messages:
+                if message['id'] in moved_ids:
+                    acker.add(message)
+                    settled.add(message['id'])
+                    count('skipped', 1)
+                elif filter is not None and not filter(message):
+                    if drop_filtered:
+                        acker.add(message)
+                    else:
+                        with lock:
+                            held.append(message)
+                    settled.add(message['id'])
+                    count('filtered', 1)
+                else:
+                    out.append(payload(message))
+                    moving.append(message)
+            if out:
+                destination.post(*out)
+        except Exception as e:
+            failed = [m for m in messages if m['id'] not in settled]
+            log.exception("Failed to move %d messages from %s to %s",
+                          len(failed), source.name, destination.name)
+            give_back(len(messages))
+            count('failed', len(failed))
+            stats.error = e
+            stopping.set()
+            source.release_many(failed)
+            return
+        give_back(len(messages) - len(moving))
+        if log_file is not None:
+            log_file.write(''.join('%s\n' % m['id'] for m in moving))
+            log_file.flush()
+        for message in moving:
+            acker.add(message)
+        count('moved', len(moving))
+
+    def work():
+        while not stopping.is_set():
+            n = take(batch)
+            if n <= 0:
+                return
+            try:
+                messages = source.reserve(max=n, timeout=timeout, wait=wait)['messages']
+            except Exception as e:
+                give_back(n)
+                stats.error = e
+                stopping.set()
+                return
+            give_back(n - len(messages))
+            if not messages:
+                return
+            move(messages)
+            if progress is not None:
+                with lock:
+                    now = time.time()
+                    report = now - reported[0] >= progress_interval
+                    if report:
+                        reported[0] = now
+                        stats.elapsed = now - started
+                        stats.undeleted = acker.failed
+                if report:
+                    progress(stats)
+
+    workers = [threading.Thread(target=work, name='iron_mq-transfer-%d' % i)
+               for i in range(concurrency)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        acker.close()
+        if held:
+            source.release_many(held)
+        if log_file is not None:
+            log_file.close()
+    stats.undeleted = acker.failed
+    if stats.error is None:
+        stats.error = acker.error
+    stats.elapsed = time.time() - started
+    return stats
+
+
+def _import(path):
+    """Returns the object named by a 'module:name' path."""
+    module, _, name = path.partition(':')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def main(argv=None):
+    """Command line interface: python -m iron_mq transfer SOURCE DESTINATION"""
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='python -m iron_mq')
+    parser.add_argument('--host', help='the API host')
+    parser.add_argument('--port', type=int, help='the API port')
+    parser.add_argument('--protocol', help='http or https')
+    parser.add_argument('--project-id', help='the project id')
+    parser.add_argument('--token', help='the OAuth token')
+    commands = parser.add_subparsers(dest='command')
+
+    move = commands.add_parser(
+        'transfer', help='move messages from one queue to another')
+    move.add_argument('source', help='the queue to move messages from')
+    move.add_argument('destination', help='the queue to move messages to')
+    move.add_argument('--max-messages', type=int,
+                      help='stop after moving this many messages')
+    move.add_argument('--batch', type=int, default=100,
+                      help='messages reserved and posted at once')
+    move.add_argument('--concurrency', type=int, default=4,
+                      help='batches moved concurrently')
+    move.add_argument('--filter', metavar='MODULE:FUNCTION',
+                      help='only move messages this function returns true for')
+    move.add_argument('--transform', metavar='MODULE:FUNCTION',
+                      help='post what this function returns for each message')
+    move.add_argument('--drop-filtered', action='store_true',
+                      help='delete messages the filter rejects')
+    move.add_argument('--checkpoint', metavar='FILE',
+                      help='record progress in FILE, to resume from it')
+    move.add_argument('--timeout', type=int, default=300,
+                      help='reservation timeout, in seconds')
+    move.add_argument('--wait', type=int, default=1,
+                      help='long poll time before the source counts as empty')
+    move.add_argument('--progress-interval', type=float, default=5,
+                      help='seconds between progress reports')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a command is required')
+
+    options = dict((k, v) for k, v in (('host', args.host), ('port', args.port),
+                                        ('protocol', args.protocol),
+                                        ('project_id', args.project_id),
+                                        ('token', args.token))
+                   if v is not None)
+    mq = IronMQ(**options)
+
+    def report(stats):
+        sys.stderr.write('%d moved, %d filtered, %d skipped, %d undeleted, '
+                         '%.1f msgs/sec\n' % (stats.moved, stats.filtered,
+                                              stats.skipped, stats.undeleted,
+                                              stats.rate))
+
+    stats = transfer(
+        mq.queue(args.source), mq.queue(args.destination),
+        max_messages=args.max_messages, batch=args.batch,
+        concurrency=args.concurrency,
+        filter=_import(args.filter) if args.filter else None,
+        transform=_import(args.transform) if args.transform else None,
+        drop_filtered=args.drop_filtered, checkpoint=args.checkpoint,
+        timeout=args.timeout, wait=args.wait, progress=report,
+        progress_interval=args.progress_interval)
+    report(stats)
+    if stats.error is not None:
+        sys.stderr.write('Transfer failed: %s\n' % stats.error)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
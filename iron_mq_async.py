@@ -0,0 +1,462 @@
+"""asyncio flavour of the IronMQ client.
+
+AsyncIronMQ and AsyncQueue mirror IronMQ and Queue, but every method that
+talks to the service is a coroutine. All queues of a client share one pool of
+keep-alive connections, so a single event loop can keep many requests, such
+as long polling reservations, in flight at once.
+"""
+import asyncio
+import ssl
+import time
+
+import iron_core
+import requests
+
+from iron_mq import IronMQ, basestring, get_codec, urlencode
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.time()
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive HTTP/1.1 connections to a single host."""
+
+    def __init__(self, host, port, use_ssl=True, max_connections=100,
+                 idle_timeout=30):
+        """Arguments:
+        host -- The host to connect to.
+        port -- The port to connect to.
+        use_ssl -- Whether connections use TLS.
+        max_connections -- The maximum number of open connections. Requests
+                           wait for a free connection beyond that.
+        idle_timeout -- Seconds after which an unused connection is closed.
+        """
+        self.host = host
+        self.port = port
+        self.ssl = ssl.create_default_context() if use_ssl else None
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._semaphore = None
+
+    async def request(self, method, path, headers, body=b''):
+        """Sends a request and returns (status, headers, body bytes)."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            conn, reused = await self._acquire()
+            try:
+                response = await self._roundtrip(conn, method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if not reused:
+                    raise
+                # The server closed an idle connection; retry on a new one.
+                conn, reused = await self._acquire(fresh=True)
+                try:
+                    response = await self._roundtrip(conn, method, path, headers, body)
+                except BaseException:
+                    conn.close()
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+            status, resp_headers, resp_body = response
+            if resp_headers.get('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+            return response
+
+    def close(self):
+        """Closes all idle connections."""
+        while self._idle:
+            self._idle.pop().close()
+
+    async def _acquire(self, fresh=False):
+        now = time.time()
+        while self._idle and not fresh:
+            conn = self._idle.pop()
+            if (now - conn.last_used < self.idle_timeout and
+                    not conn.reader.at_eof()):
+                return conn, True
+            conn.close()
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl,
+            server_hostname=self.host if self.ssl else None)
+        return _Connection(reader, writer), False
+
+    async def _roundtrip(self, conn, method, path, headers, body):
+        host = self.host
+        if self.port != (443 if self.ssl else 80):
+            host = "%s:%s" % (host, self.port)
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % host,
+                 "Content-Length: %d" % len(body)]
+        lines.extend("%s: %s" % item for item in headers.items())
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+        conn.writer.write(head + body)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        resp_headers = {}
+        while True:
+            line = await conn.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+
+        if resp_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await conn.reader.readuntil(b"\r\n")).split(b';')[0], 16)
+                if size == 0:
+                    while await conn.reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readexactly(2)
+            resp_body = b''.join(chunks)
+        elif 'content-length' in resp_headers:
+            resp_body = await conn.reader.readexactly(int(resp_headers['content-length']))
+        elif status in (204, 304) or method == 'HEAD':
+            resp_body = b''
+        else:
+            resp_body = await conn.reader.read()
+            resp_headers['connection'] = 'close'
+        return status, resp_headers, resp_body
+
+
+class AsyncQueue(object):
+    client = None
+    name = None
+
+    def __init__(self, mq, name):
+        """Creates object for manipulating a queue.
+
+        Arguments:
+        mq -- An instance of AsyncIronMQ.
+        name -- The name of the queue.
+        """
+        self.client = mq
+        self.name = name
+
+    async def info(self):
+        """Get details on a queue."""
+        url = "queues/%s" % (self.name,)
+        result = await self.client._request("GET", url)
+
+        return result['body']['queue']
+
+    async def size(self):
+        """Queue size"""
+        return (await self.info())['size']
+
+    async def id(self):
+        """Queue ID"""
+        return (await self.info())['id']
+
+    async def total_messages(self):
+        """Queue total messages count"""
+        return (await self.info())['total_messages']
+
+    async def clear(self):
+        """Clear all contents of a queue."""
+        url = "queues/%s/messages" % self.name
+        result = await self.client._request("DELETE", url, {})
+
+        return result['body']
+
+    async def delete(self, message_id, reservation_id=None, subscriber_name=None):
+        """Delete a message from queue. See Queue.delete."""
+        url = "queues/%s/messages/%s" % (self.name, message_id)
+        qitems = {}
+        if reservation_id is not None:
+            qitems['reservation_id'] = reservation_id
+        if subscriber_name is not None:
+            qitems['subscriber_name'] = subscriber_name
+
+        result = await self.client._request("DELETE", url, qitems)
+
+        return result['body']
+
+    async def delete_multiple(self, ids=None, messages=None):
+        """Delete messages from queue. See Queue.delete_multiple."""
+        url = "queues/%s/messages" % self.name
+
+        items = None
+        if ids is None and messages is None:
+            raise Exception('Please, specify at least one parameter.')
+        if ids is not None:
+            items = [{'id': item} for item in ids]
+        if messages is not None:
+            items = [{'id': item['id'], 'reservation_id': item['reservation_id']}
+                     for item in messages['messages']]
+
+        result = await self.client._request("DELETE", url, {'ids': items})
+        return result['body']
+
+    async def post(self, *messages):
+        """Create messages on the queue. See Queue.post."""
+        url = "queues/%s/messages" % self.name
+
+        msgs = [{'body': msg} if isinstance(msg, basestring) else msg
+                for msg in messages]
+
+        result = await self.client._request("POST", url, {'messages': msgs})
+
+        return result['body']
+
+    async def reserve(self, max=None, timeout=None, wait=None, delete=None,
+                      raw=False):
+        """Retrieves Messages from the queue and reserves it. See
+        Queue.reserve.
+        """
+        url = "queues/%s/reservations" % self.name
+        qitems = {}
+        if max is not None:
+            qitems['n'] = max
+        if timeout is not None:
+            qitems['timeout'] = timeout
+        if wait is not None:
+            qitems['wait'] = wait
+        if delete is not None:
+            qitems['delete'] = delete
+
+        response = await self.client._request("POST", url, qitems, raw=raw)
+
+        return response['body']
+
+    async def get_message_by_id(self, message_id):
+        url = "queues/%s/messages/%s" % (self.name, message_id)
+        response = await self.client._request("GET", url)
+        return response['body']['message']
+
+    async def peek(self, max=None, raw=False):
+        url = "queues/%s/messages" % self.name
+        if max is not None:
+            url = "%s?n=%s" % (url, max)
+
+        response = await self.client._request("GET", url, raw=raw)
+
+        return response['body']
+
+    async def touch(self, message_id, reservation_id, timeout=None):
+        """Extends the reservation of a message. See Queue.touch."""
+        url = "queues/%s/messages/%s/touch" % (self.name, message_id)
+        qitems = {'reservation_id': reservation_id}
+        if timeout is not None:
+            qitems['timeout'] = timeout
+
+        response = await self.client._request("POST", url, qitems)
+
+        return response['body']
+
+    async def release(self, message_id, reservation_id, delay=0):
+        """Release a reserved message. See Queue.release."""
+        url = "queues/%s/messages/%s/release" % (self.name, message_id)
+        body = {'reservation_id': reservation_id}
+        if delay > 0:
+            body['delay'] = delay
+
+        response = await self.client._request("POST", url, body)
+
+        return response['body']
+
+    async def update(self, options=None):
+        url = "queues/%s" % self.name
+
+        body = {}
+        if options is not None:
+            body = {'queue': options}
+
+        response = await self.client._request("PATCH", url, body)
+        return response['body']['queue']
+
+    async def delete_queue(self):
+        url = "queues/%s" % self.name
+
+        response = await self.client._request("DELETE", url)
+
+        return response['body']
+
+    async def add_subscribers(self, *subscribers):
+        url = "queues/%s/subscribers" % self.name
+
+        response = await self.client._request("POST", url,
+                                              {'subscribers': subscribers})
+
+        return response['body']
+
+    async def remove_subscribers(self, *subscribers):
+        url = "queues/%s/subscribers" % self.name
+        body = {'subscribers': [{'name': ss} for ss in subscribers]}
+
+        response = await self.client._request("DELETE", url, body)
+
+        return response['body']
+
+    async def replace_subscribers(self, *subscribers):
+        url = "queues/%s/subscribers" % self.name
+
+        response = await self.client._request("PUT", url,
+                                              {'subscribers': subscribers})
+
+        return response['body']
+
+    async def get_message_push_statuses(self, message_id):
+        url = "queues/%s/messages/%s/subscribers" % (self.name, message_id)
+
+        response = await self.client._request("GET", url)
+
+        return response['body']
+
+
+class AsyncIronMQ(object):
+    NAME = IronMQ.NAME
+    VERSION = IronMQ.VERSION
+    API_VERSION = IronMQ.API_VERSION
+    client = None
+    name = None
+
+    def __init__(self, name=None, max_connections=100, idle_timeout=30,
+                 codec=None, **kwargs):
+        """Prepare a configured instance of the asyncio API wrapper.
+
+        Keyword arguments:
+        max_connections -- The maximum number of connections kept open to the
+                           service. Requests wait for a free connection
+                           beyond that.
+        idle_timeout -- Seconds after which an unused connection is closed.
+        codec -- The JSON codec used for request and response bodies. See
+                 IronMQ.
+
+        Other keyword arguments are passed directly to iron_core_python, which
+        is used to resolve the configuration.
+        """
+        if name is not None:
+            self.name = name
+        kwargs['api_version'] = kwargs.get('api_version') or AsyncIronMQ.API_VERSION
+
+        self.client = iron_core.IronClient(name=AsyncIronMQ.NAME,
+                version=AsyncIronMQ.VERSION, product='iron_mq', **kwargs)
+
+        self.codec = get_codec(codec)
+
+        base = urlparse(self.client.base_url)
+        self._base_path = base.path
+        self.pool = ConnectionPool(base.hostname,
+                                   base.port or (443 if base.scheme == 'https' else 80),
+                                   use_ssl=base.scheme == 'https',
+                                   max_connections=max_connections,
+                                   idle_timeout=idle_timeout)
+
+    async def queues(self, page=None, per_page=None, previous=None, prefix=None):
+        """Get a list of queue names. See IronMQ.queues."""
+        options = {}
+        if page is not None:
+            raise Exception('page param is deprecated!')
+        if per_page is not None:
+            options['per_page'] = per_page
+        if previous is not None:
+            options['previous'] = previous
+        if prefix is not None:
+            options['prefix'] = prefix
+
+        query = urlencode(options)
+        url = 'queues'
+        if query != '':
+            url = "%s?%s" % (url, query)
+        result = await self._request("GET", url)
+
+        return [queue['name'] for queue in result['body']['queues']]
+
+    def queue(self, queue_name):
+        """Returns AsyncQueue object.
+
+        Arguments:
+        queue_name -- The name of the queue.
+        """
+        return AsyncQueue(self, queue_name)
+
+    async def create_queue(self, queue_name, options=None):
+        body = {}
+        if options is not None:
+            body = {'queue': options}
+        url = "queues/%s" % queue_name
+        response = await self._request("PUT", url, body)
+        return response['body']['queue']
+
+    async def update_queue(self, queue_name, options=None):
+        body = {}
+        if options is not None:
+            body = {'queue': options}
+        url = "queues/%s" % queue_name
+        response = await self._request("PATCH", url, body)
+        return response['body']['queue']
+
+    def close(self):
+        """Closes idle connections of the pool."""
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _request(self, method, url, body=None, raw=False):
+        headers = dict(self.client.headers)
+        headers['Authorization'] = "OAuth %s" % self.client.token_provider.getToken()
+        data = b''
+        if body is not None:
+            data = self.codec.dumps(body)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        path = self._base_path + url
+
+        status, resp_headers, content = await self.pool.request(method, path, headers, data)
+        delay = .5
+        tries = 5
+        while status in (503, 504) and tries > 0:
+            tries -= 1
+            await asyncio.sleep(delay)
+            delay *= 2
+            status, resp_headers, content = await self.pool.request(method, path, headers, data)
+
+        if status >= 400:
+            response = requests.Response()
+            response.status_code = status
+            response.headers.update(resp_headers)
+            response._content = content
+            response.url = self.client.base_url + url
+            raise requests.HTTPError("%s Error for url: %s" % (status, response.url),
+                                     response=response)
+
+        content_type = resp_headers.get('content-type', 'text/plain').split(';')[0]
+        result = {'status': status, 'content-type': content_type}
+        if raw:
+            result['body'] = content
+        elif content_type.lower() == 'application/json':
+            try:
+                result['body'] = self.codec.loads(content)
+            except ValueError:
+                result['body'] = content.decode('utf-8')
+        else:
+            result['body'] = content.decode('utf-8')
+        return result
@@ -0,0 +1,390 @@
+"""In-memory stand-in for the IronMQ v3 API.
+
+FakeIronMQ implements the endpoints used by iron_mq, including reservation
+timeouts, message delays and long polling, so that clients can be tested and
+benchmarked without network access or credentials:
+
+    fake = FakeIronMQ()
+    ironmq = fake.client()            # requests are served in-process
+    server = fake.serve()             # or over HTTP on a local port
+    ironmq = IronMQ(**server.config)
+"""
+import itertools
+import threading
+import time
+import uuid
+
+import requests
+
+from iron_mq import IronMQ, json
+
+try:
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+MAX_MESSAGES = 100
+
+_REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 403: 'Forbidden',
+            404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class FakeError(Exception):
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.msg = msg
+
+
+class _FakeQueue(object):
+    def __init__(self, name, project_id, options):
+        self.name = name
+        self.project_id = project_id
+        self.options = {'message_timeout': 60,
+                        'message_expiration': 604800,
+                        'type': 'pull'}
+        self.messages = {}
+        self.total_messages = 0
+        self.update(options)
+
+    def update(self, options):
+        options = dict(options or {})
+        push = options.pop('push', None)
+        self.options.update(options)
+        if push is not None:
+            self.options.setdefault('push', {}).update(push)
+            if self.options['type'] == 'pull':
+                self.options['type'] = 'multicast'
+
+    def info(self):
+        info = dict(self.options)
+        info.update({'name': self.name, 'project_id': self.project_id,
+                     'size': len(self.messages),
+                     'total_messages': self.total_messages})
+        return info
+
+    def subscribers(self):
+        return self.options.setdefault('push', {}).setdefault('subscribers', [])
+
+    def expire(self, now):
+        for id in [id for id, m in self.messages.items() if m['expires_at'] <= now]:
+            del self.messages[id]
+
+    def available(self, now):
+        self.expire(now)
+        ready = [m for m in self.messages.values() if m['available_at'] <= now]
+        ready.sort(key=lambda m: m['seq'])
+        return ready
+
+    def next_available(self):
+        if not self.messages:
+            return None
+        return min(m['available_at'] for m in self.messages.values())
+
+    def reserved(self, message_id, reservation_id, now):
+        message = self.messages.get(message_id)
+        if message is None:
+            raise FakeError(404, 'Message not found')
+        if (message['reservation_id'] is None or
+                message['reservation_id'] != reservation_id or
+                message['available_at'] <= now):
+            raise FakeError(403, 'Reservation does not match or has expired')
+        return message
+
+
+class FakeIronMQ(object):
+    """An in-memory IronMQ v3 service for a single project."""
+
+    def __init__(self, project_id='fake_project', token='fake_token'):
+        self.project_id = project_id
+        self.token = token
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._ids = itertools.count(6000000000000000000)
+
+    def client(self, **kwargs):
+        """Returns an IronMQ instance whose requests are served in-process by
+        this stand-in. Keyword arguments are passed to IronMQ.
+        """
+        kwargs.setdefault('project_id', self.project_id)
+        kwargs.setdefault('token', self.token)
+        kwargs.setdefault('host', 'localhost')
+        kwargs.setdefault('protocol', 'http')
+        kwargs.setdefault('port', 80)
+        kwargs.setdefault('transport', self)
+        return IronMQ(**kwargs)
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Serves the API over HTTP from a background thread and returns the
+        server. Its config attribute holds the IronMQ keyword arguments to
+        connect to it; call shutdown() to stop it.
+        """
+        server = _ThreadingHTTPServer((host, port), _Handler)
+        server.fake = self
+        server.daemon_threads = True
+        server.config = {'host': server.server_address[0],
+                         'port': server.server_address[1],
+                         'protocol': 'http',
+                         'project_id': self.project_id,
+                         'token': self.token}
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='iron_mq-fake-server')
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def request(self, method, url, body="", headers={}):
+        """Transport interface of IronMQ: serves a request and returns a
+        requests.Response.
+        """
+        status, payload = self.handle(method, url, body)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = _REASONS.get(status, '')
+        response.url = url
+        response.headers['Content-Type'] = 'application/json'
+        response._content = payload
+        response.encoding = 'utf-8'
+        return response
+
+    def handle(self, method, url, body=""):
+        """Serves a request and returns its status code and encoded JSON
+        response body.
+        """
+        parsed = urlparse(url)
+        parts = [unquote(p) for p in parsed.path.split('/') if p]
+        query = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        try:
+            data = json.loads(body) if body else {}
+            if (len(parts) < 4 or parts[1] != 'projects' or
+                    parts[2] != self.project_id):
+                raise FakeError(404, 'Project not found')
+            status, result = 200, self._dispatch(method, parts[3:], query, data)
+        except FakeError as e:
+            status, result = e.status, {'msg': e.msg}
+        except (ValueError, KeyError, TypeError) as e:
+            status, result = 400, {'msg': 'Bad request: %s' % e}
+        return status, json.dumps(result).encode('utf-8')
+
+    def _dispatch(self, method, parts, query, data):
+        if parts[0] != 'queues':
+            raise FakeError(404, 'Not found')
+        if len(parts) == 1 and method == 'GET':
+            return self._list_queues(query)
+        name = parts[1] if len(parts) > 1 else None
+        route = (method,) + tuple(p if i % 2 == 0 else '*'
+                                  for i, p in enumerate(parts[2:]))
+        message_id = parts[3] if len(parts) > 3 else None
+
+        with self._cond:
+            if route == ('PUT',):
+                return self._create_queue(name, data)
+            if route == ('POST', 'messages'):
+                return self._post(name, data)
+            if route == ('POST', 'reservations'):
+                return self._reserve(name, data)
+
+            queue = self._queues.get(name)
+            if queue is None:
+                raise FakeError(404, 'Queue not found')
+            now = time.time()
+            if route == ('GET',):
+                return {'queue': queue.info()}
+            if route == ('PATCH',):
+                queue.update(data.get('queue'))
+                return {'queue': queue.info()}
+            if route == ('DELETE',):
+                del self._queues[name]
+                return {'msg': 'Deleted'}
+            if route == ('GET', 'messages'):
+                n = int(query.get('n', 1))
+                return {'messages': [self._message(m) for m in
+                                     queue.available(now)[:n]]}
+            if route == ('DELETE', 'messages'):
+                return self._delete_multiple(queue, data, now)
+            if route == ('GET', 'messages', '*'):
+                queue.expire(now)
+                if message_id not in queue.messages:
+                    raise FakeError(404, 'Message not found')
+                return {'message': self._message(queue.messages[message_id])}
+            if route == ('DELETE', 'messages', '*'):
+                self._delete(queue, message_id, data.get('reservation_id'), now)
+                return {'msg': 'Deleted'}
+            if route == ('POST', 'messages', '*', 'touch'):
+                message = queue.reserved(message_id, data['reservation_id'], now)
+                timeout = data.get('timeout') or queue.options['message_timeout']
+                message['reservation_id'] = uuid.uuid4().hex
+                message['available_at'] = now + timeout
+                return {'msg': 'Touched', 'reservation_id': message['reservation_id']}
+            if route == ('POST', 'messages', '*', 'release'):
+                message = queue.reserved(message_id, data['reservation_id'], now)
+                message['reservation_id'] = None
+                message['available_at'] = now + data.get('delay', 0)
+                self._cond.notify_all()
+                return {'msg': 'Released'}
+            if route == ('GET', 'messages', '*', 'subscribers'):
+                if message_id not in queue.messages:
+                    raise FakeError(404, 'Message not found')
+                return {'subscribers': [
+                    {'subscriber_name': s['name'], 'url': s.get('url'),
+                     'status': 'queued', 'status_code': None}
+                    for s in queue.subscribers()]}
+            if route == ('POST', 'subscribers'):
+                subscribers = queue.subscribers()
+                names = [s['name'] for s in data['subscribers']]
+                subscribers[:] = [s for s in subscribers if s['name'] not in names]
+                subscribers.extend(data['subscribers'])
+                return {'msg': 'Updated'}
+            if route == ('PUT', 'subscribers'):
+                queue.subscribers()[:] = data['subscribers']
+                return {'msg': 'Updated'}
+            if route == ('DELETE', 'subscribers'):
+                names = [s['name'] for s in data['subscribers']]
+                subscribers = queue.subscribers()
+                subscribers[:] = [s for s in subscribers if s['name'] not in names]
+                return {'msg': 'Updated'}
+        raise FakeError(405, 'Method not allowed')
+
+    def _list_queues(self, query):
+        per_page = int(query.get('per_page', 30))
+        if not 0 < per_page <= 100:
+            raise FakeError(400, 'per_page must be between 1 and 100')
+        previous = query.get('previous', '')
+        prefix = query.get('prefix', '')
+        with self._cond:
+            names = sorted(n for n in self._queues
+                           if n > previous and n.startswith(prefix))
+        return {'queues': [{'name': n} for n in names[:per_page]]}
+
+    def _create_queue(self, name, data):
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = _FakeQueue(name, self.project_id, data.get('queue'))
+            self._queues[name] = queue
+        else:
+            queue.update(data.get('queue'))
+        return {'queue': queue.info()}
+
+    def _post(self, name, data):
+        messages = data['messages']
+        if not 0 < len(messages) <= MAX_MESSAGES:
+            raise FakeError(400, 'Between 1 and %d messages can be posted at once' %
+                            MAX_MESSAGES)
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = self._queues[name] = _FakeQueue(name, self.project_id, None)
+        now = time.time()
+        # Validate all messages before storing any, like the service does.
+        available = [now + message.get('delay', 0) for message in messages]
+        bodies = [message['body'] for message in messages]
+        ids = []
+        for body, available_at in zip(bodies, available):
+            id = str(next(self._ids))
+            queue.messages[id] = {
+                'id': id, 'body': body, 'seq': int(id),
+                'reserved_count': 0, 'reservation_id': None,
+                'available_at': available_at,
+                'expires_at': now + queue.options['message_expiration']}
+            ids.append(id)
+        queue.total_messages += len(ids)
+        self._cond.notify_all()
+        return {'ids': ids, 'msg': 'Messages put on queue.'}
+
+    def _reserve(self, name, data):
+        n = data.get('n', 1)
+        if not 0 < n <= MAX_MESSAGES:
+            raise FakeError(400, 'n must be between 1 and %d' % MAX_MESSAGES)
+        deadline = time.time() + min(data.get('wait', 0), 30)
+        while True:
+            queue = self._queues.get(name)
+            if queue is None:
+                raise FakeError(404, 'Queue not found')
+            now = time.time()
+            available = queue.available(now)[:n]
+            if available or now >= deadline:
+                break
+            wake = deadline
+            next_available = queue.next_available()
+            if next_available is not None and next_available < wake:
+                wake = next_available
+            self._cond.wait(max(wake - now, 0.001))
+
+        timeout = data.get('timeout') or queue.options['message_timeout']
+        reserved = []
+        for message in available:
+            message['reserved_count'] += 1
+            if data.get('delete'):
+                del queue.messages[message['id']]
+            else:
+                message['reservation_id'] = uuid.uuid4().hex
+                message['available_at'] = now + timeout
+            reserved.append(self._message(message))
+        return {'messages': reserved}
+
+    def _delete(self, queue, message_id, reservation_id, now):
+        message = queue.messages.get(message_id)
+        if message is None:
+            raise FakeError(404, 'Message not found')
+        if message['reservation_id'] is not None and message['available_at'] > now:
+            queue.reserved(message_id, reservation_id, now)
+        del queue.messages[message_id]
+
+    def _delete_multiple(self, queue, data, now):
+        if 'ids' not in data:
+            queue.messages.clear()
+            return {'msg': 'Cleared'}
+        if len(data['ids']) > MAX_MESSAGES:
+            raise FakeError(400, 'At most %d messages can be deleted at once' %
+                            MAX_MESSAGES)
+        for item in data['ids']:
+            message = queue.messages.get(item['id'])
+            if message is None:
+                raise FakeError(404, 'Message not found: %s' % item['id'])
+            if message['reservation_id'] is not None and message['available_at'] > now:
+                queue.reserved(item['id'], item.get('reservation_id'), now)
+        for item in data['ids']:
+            del queue.messages[item['id']]
+        return {'msg': 'Deleted'}
+
+    def _message(self, message):
+        result = {'id': message['id'], 'body': message['body'],
+                  'reserved_count': message['reserved_count']}
+        if message['reservation_id'] is not None:
+            result['reservation_id'] = message['reservation_id']
+        return result
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; with Nagle's algorithm the
+    # body of a response on a kept-alive connection waits for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, payload = self.server.fake.handle(self.command, self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
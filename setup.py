@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
         name = "iron-mq",
-        py_modules = ["iron_mq"],
+        py_modules = ["iron_mq", "iron_mq_async", "iron_mq_fake"],
         install_requires = ["iron_core"],
         version = "0.9",
         description = "Client library for IronMQ, a message queue in the cloud",
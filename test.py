@@ -1,14 +1,44 @@
 from iron_mq import *
+from iron_mq_fake import FakeIronMQ
+import iron_mq
 import unittest
+import os
 import random
+import requests
+import shutil
+import tempfile
+import threading
 import time
 
 
+def _crash_once(body):
+    """ProcessConsumer handler killing its worker process the first time it
+    sees a "crash:<marker path>" body.
+    """
+    if body.startswith("crash:") and not os.path.exists(body[6:]):
+        open(body[6:], "w").close()
+        os._exit(1)
+    return body
+
+
 class TestIronMQ(unittest.TestCase):
     def setUp(self):
-        self.mq =  IronMQ()
+        self.fake = None
+        try:
+            self.mq =  IronMQ()
+        except ValueError:
+            # No credentials configured, run against the in-memory stand-in.
+            self.fake = FakeIronMQ()
+            self.mq = self.fake.client()
+            self.mq.create_queue("test_queue")
         self.random_number = str(int(random.random() * 10 ** 10))
 
+    def client(self, **kwargs):
+        """Another client for the service the tests run against."""
+        if self.fake is None:
+            return IronMQ(**kwargs)
+        return self.fake.client(**kwargs)
+
     def test_postMessage(self):
         q = self.mq.queue("test_queue")
         old_size = q.size()
@@ -196,6 +226,763 @@ class TestIronMQ(unittest.TestCase):
         response = q.peek(2)
         self.assertEqual(2, len(response["messages"]))
 
+    def test_listQueuesPages(self):
+        prefix = "test_list%s_" % self.random_number
+        names = ["%s%02d" % (prefix, i) for i in range(5)]
+        for name in names:
+            self.mq.create_queue(name)
+        first = self.mq.queues(per_page=3, prefix=prefix)
+        second = self.mq.queues(per_page=3, prefix=prefix, previous=first[-1])
+        self.assertEqual(names, first + second)
+        for name in names:
+            self.mq.queue(name).delete_queue()
+
+    def test_iterQueues(self):
+        prefix = "test_iter%s_" % self.random_number
+        names = ["%s%02d" % (prefix, i) for i in range(5)]
+        for name in names:
+            self.mq.create_queue(name)
+        self.assertEqual(names, list(self.mq.iter_queues(prefix=prefix, per_page=2)))
+        infos = list(self.mq.iter_queues(prefix=prefix, per_page=2,
+                                         prefetch=False, info=True))
+        self.assertEqual(names, [info["name"] for info in infos])
+        for name in names:
+            self.mq.queue(name).delete_queue()
+
+    def test_cachedInfo(self):
+        mq = self.client(cache_ttl=60)
+        q = mq.queue("test_queue")
+        q.clear()
+        self.assertEqual(0, q.size())
+        self.mq.queue("test_queue").post("not seen through the cache")
+        self.assertEqual(0, q.size())
+        q.post("invalidates the cache")
+        self.assertEqual(2, q.size())
+        infos = mq.queue_infos(["test_queue"])
+        self.assertEqual(2, infos["test_queue"]["size"])
+
+    def test_codecs(self):
+        for codec in ('json', 'auto'):
+            mq = self.client(codec=codec)
+            q = mq.queue("test_queue")
+            q.clear()
+            data = mq.client.codec.dumps({"messages": [{"body": "encoded"}]})
+            ids = q.post_encoded(data)["ids"]
+            raw = q.reserve(raw=True)
+            self.assertTrue(isinstance(raw, bytes))
+            message = mq.client.codec.loads(raw)["messages"][0]
+            self.assertEqual(ids[0], message["id"])
+            self.assertEqual("encoded", message["body"])
+
+    def test_bulkOperations(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        for i in range(3):
+            q.post(*["message %s" % j for j in range(100)])
+        messages = []
+        while len(messages) < 250:
+            messages.extend(q.reserve(100, timeout=60)["messages"])
+        messages = messages[:250]
+
+        touched = q.touch_many(messages[:10])
+        self.assertTrue(touched.ok)
+        for message in messages[:10]:
+            message["reservation_id"] = touched.reservation_ids[message["id"]]
+        released = q.release_many(messages[240:])
+        self.assertEqual(10, len(released.succeeded))
+
+        stale = dict(messages[0], reservation_id="stale")
+        result = q.delete_many(messages=messages[:240] + [stale], chunk_size=50)
+        self.assertEqual(240, len(result.succeeded))
+        self.assertEqual([stale["id"]], list(result.failed))
+        self.assertEqual(60, q.size())
+
+    def test_deleteManyIds(self):
+        mq = self.client()
+        q = mq.queue("test_queue")
+        q.clear()
+        ids = []
+        for i in range(3):
+            ids += q.post(*["message %s" % j for j in range(100)])["ids"]
+        events = []
+        mq.add_observer(events.append)
+        result = q.delete_many(ids=ids)
+        self.assertTrue(result.ok)
+        self.assertEqual(3, len([e for e in events if e.method == "DELETE"]))
+        self.assertEqual(0, q.size())
+
+    def test_retryPolicy(self):
+        if self.fake is None:
+            self.skipTest("needs the in-memory stand-in to inject failures")
+        fake = self.fake
+        failures = []
+
+        class Flaky(object):
+            def request(self, method, url, body, headers):
+                if failures:
+                    response = requests.Response()
+                    response.status_code = failures.pop()
+                    response.headers["Retry-After"] = "0"
+                    response._content = b'{"msg": "Service Unavailable"}'
+                    return response
+                return fake.request(method, url, body, headers)
+
+        policy = RetryPolicy(base_delay=0.01, breaker_threshold=3,
+                             breaker_timeout=60)
+        q = self.client(transport=Flaky(), retry_policy=policy).queue("test_queue")
+        q.clear()
+
+        failures[:] = [503, 503]
+        q.post("retried")
+        self.assertEqual(1, len(q.reserve()["messages"]))
+
+        failures[:] = [504]
+        self.assertRaises(requests.HTTPError, q.post, "not retried")
+
+        failures[:] = [503] * 3
+        self.assertRaises(CircuitOpenError, q.peek)
+        self.assertRaises(CircuitOpenError, q.peek)
+        self.assertEqual(0, len(failures))
+        self.assertEqual(1, q.size())
+
+    def test_observers(self):
+        mq = self.client()
+        metrics = MetricsObserver()
+        events = []
+        mq.add_observer(metrics)
+        mq.add_observer(events.append)
+        q = mq.queue("test_queue")
+        with trace("test") as t:
+            q.post("observed")
+        mq.remove_observer(events.append)
+        q.reserve()
+
+        self.assertEqual(1, len(events))
+        event = events[0]
+        self.assertEqual(("post", "test_queue", 200), (event.operation, event.queue, event.status))
+        self.assertEqual(t.trace_id, event.trace_id)
+        self.assertTrue(event.bytes_out > 0 and event.bytes_in > 0)
+        self.assertTrue(event.encode_time > 0 and event.total_time >= event.request_time)
+        text = metrics.prometheus()
+        self.assertTrue('iron_mq_requests_total{operation="post",queue="test_queue",status="200"} 1' in text)
+        self.assertTrue('iron_mq_request_duration_seconds_count{operation="reserve",queue="test_queue"} 1' in text)
+
+        # Bodies encoded in the caller's thread and posted from a background
+        # thread are charged to the post, not to the caller's next request.
+        events = []
+        mq.add_observer(events.append)
+        producer = BatchingProducer(q)
+        producer.post("batched").result(10)
+        producer.close()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spool = q.spool(directory)
+        spool.post("spooled")
+        self.assertTrue(spool.flush(10))
+        spool.close()
+        q.info()
+        posts = [e for e in events if e.operation == "post"]
+        self.assertEqual(2, len(posts))
+        self.assertTrue(all(e.encode_time > 0 for e in posts))
+        self.assertEqual([0.0], [e.encode_time for e in events if e.method == "GET"])
+
+    def test_ackStaleReservation(self):
+        name = "test_ack_%s" % self.random_number
+        self.mq.create_queue(name)
+        self.mq.queue(name).post(*["message %s" % i for i in range(10)])
+        consumer = MultiQueueConsumer(self.mq, [name], prefetch=10,
+                                      ack_interval=0.1).start()
+        received = [consumer.get(timeout=30)[1] for i in range(10)]
+        # One reservation expired: only that message stays on the queue.
+        consumer.ack(name, dict(received[0], reservation_id="stale"))
+        for message in received[1:]:
+            consumer.ack(name, message)
+        consumer.close()
+        self.assertEqual(1, self.mq.queue(name).size())
+        self.mq.queue(name).delete_queue()
+
+    def test_multiQueueConsumer(self):
+        names = ["test_multi%s_%s" % (self.random_number, i) for i in range(3)]
+        for i, name in enumerate(names):
+            self.mq.create_queue(name)
+            if i > 0:
+                self.mq.queue(name).post(*["%s %s" % (name, j) for j in range(10 * i)])
+        consumer = MultiQueueConsumer(self.mq, names, weights={names[2]: 2},
+                                      pollers=2, prefetch=10, min_backoff=0.1,
+                                      ack_interval=0.1).start()
+        received = []
+        while len(received) < 30:
+            item = consumer.get(timeout=30)
+            self.assertTrue(item is not None)
+            received.append(item)
+            consumer.ack(*item)
+        consumer.close()
+        self.assertEqual(10, len([name for name, m in received if name == names[1]]))
+        self.assertTrue(consumer.stats()[names[0]]["empty_polls"] > 0)
+        for name in names:
+            self.assertEqual(0, self.mq.queue(name).size())
+            self.mq.queue(name).delete_queue()
+
+    def test_compression(self):
+        q = self.mq.queue("test_queue", compression=Compression(threshold=100))
+        q.clear()
+        document = json.dumps({"items": ["item %s" % i for i in range(500)]})
+        ids = q.post(document, "short", {"body": document, "delay": 0})["ids"]
+
+        stored = self.mq.queue("test_queue").get_message_by_id(ids[0])["body"]
+        self.assertTrue(stored.startswith(ENVELOPE_PREFIX))
+        self.assertTrue(len(stored) < len(document) / 2)
+        self.assertEqual(document, q.get_message_by_id(ids[0])["body"])
+        self.assertEqual([document, "short"], [m["body"] for m in q.peek(2)["messages"]])
+        self.assertEqual(document, q.reserve(3)["messages"][2]["body"])
+
+    def test_spool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        class Down(object):
+            def request(self, method, url, body, headers):
+                raise requests.ConnectionError("unreachable")
+
+        down = self.client(transport=Down(), retry_policy=RetryPolicy(max_attempts=1))
+        spool = down.queue("test_queue").spool(directory, segment_bytes=4096,
+                                               max_bytes=8192, timeout=0.1,
+                                               retry_delay=0.01)
+        bodies = ["message %d" % i for i in range(40)] + ["x" * 3000]
+        spool.post(*bodies)
+        self.assertRaises(SpoolFullError, spool.post, "y" * 3000)
+        self.assertEqual(41, spool.pending)
+        spool.close()
+
+        q = self.mq.queue("test_queue")
+        q.clear()
+        with q.spool(directory, max_batch=25) as spool:
+            self.assertEqual(41, spool.pending)
+            self.assertTrue(spool.flush(timeout=10))
+            spool.post("after restart")
+            self.assertTrue(spool.flush(timeout=10))
+        messages = q.reserve(max=100)["messages"]
+        self.assertEqual(bodies + ["after restart"], [m["body"] for m in messages])
+        self.assertEqual(["%020d.seg" % 1, "checkpoint"], sorted(os.listdir(directory)))
+
+        # A message the server rejects does not hold up those after it.
+        with q.spool(directory) as spool:
+            spool.post("before", {"body": "bad", "delay": "soon"}, "after")
+            self.assertTrue(spool.flush(timeout=10))
+            self.assertEqual((2, 1), (spool.posted, spool.rejected))
+        messages = q.reserve(max=100)["messages"]
+        self.assertEqual(["before", "after"], [m["body"] for m in messages])
+        with open(os.path.join(directory, "rejected")) as f:
+            self.assertEqual("bad", json.loads(f.read())["body"])
+
+    def test_messageObjects(self):
+        q = self.mq.queue("test_queue", compression=Compression(threshold=10))
+        q.clear()
+        ids = q.post("a" * 100, "b", "c")["ids"]
+
+        message = q.get_message_by_id(ids[0], objects=True)
+        self.assertEqual("a" * 100, message.body)
+        self.assertEqual("b", q.peek(2, objects=True)[1]["body"])
+
+        batch = q.reserve(3, objects=True)
+        self.assertEqual(ids, [m.id for m in batch])
+        first = batch[0]
+        reservation_id = first.reservation_id
+        first.touch()
+        self.assertNotEqual(reservation_id, first.reservation_id)
+        self.assertEqual("Released", first.release()["msg"])
+        batch.pop(0)
+        batch.ack()
+        self.assertEqual(1, q.size())
+        message = q.reserve(objects=True)[0]
+        self.assertEqual(2, message.reserved_count)
+        message.delete()
+        self.assertEqual(0, q.size())
+
+    def test_rateLimiter(self):
+        events = []
+        mq = self.client(rate_limiter=RateLimiter(rate=20, burst=1))
+        mq.add_observer(events.append)
+        q = mq.queue("test_queue")
+        started = time.time()
+        for i in range(11):
+            q.post("message %d" % i)
+        self.assertTrue(time.time() - started >= 0.45)
+        self.assertTrue(sum(e.throttle_time for e in events) >= 0.45)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        limiters = [RateLimiter(rate=20, burst=1, directory=directory)
+                    for i in range(2)]
+        queues = [self.client(rate_limiter=l).queue("test_queue") for l in limiters]
+        started = time.time()
+        for i in range(11):
+            queues[i % 2].post("message %d" % i)
+        self.assertTrue(time.time() - started >= 0.45)
+
+        state = {"in_flight": 0, "peak": 0}
+        lock = threading.Lock()
+
+        def work(limiter):
+            for i in range(5):
+                limiter.acquire("post")
+                with lock:
+                    state["in_flight"] += 1
+                    state["peak"] = max(state["peak"], state["in_flight"])
+                time.sleep(0.01)
+                with lock:
+                    state["in_flight"] -= 1
+                limiter.release("post")
+
+        limiters = [RateLimiter(directory=directory,
+                                operations={"post": {"concurrency": 2}})
+                    for i in range(2)]
+        threads = [threading.Thread(target=work, args=(limiters[i % 2],))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, state["peak"])
+
+    def test_claimCheck(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = FileBlobStore(directory)
+        q = self.mq.queue("test_queue", claim_check=ClaimCheck(store, threshold=1000))
+        q.clear()
+        document = "x" * 100000
+        ids = q.post(document, "small", document)["ids"]
+
+        stored = self.mq.queue("test_queue").get_message_by_id(ids[0])["body"]
+        self.assertTrue(stored.startswith(ENVELOPE_PREFIX))
+        self.assertTrue(len(stored) < 100)
+        self.assertEqual(2, sum(len(files) for _, _, files in os.walk(directory)))
+
+        messages = q.reserve(2)["messages"]
+        self.assertEqual([document, "small"], [m["body"] for m in messages])
+        q.delete_multiple(messages={"messages": messages})
+        self.assertEqual(1, sum(len(files) for _, _, files in os.walk(directory)))
+
+        message = q.reserve(objects=True)[0]
+        with message.open() as f:
+            self.assertEqual(b"x" * 10, f.read(10))
+        message.delete()
+        self.assertEqual(0, sum(len(files) for _, _, files in os.walk(directory)))
+
+        # Blobs of messages the service rejected are deleted.
+        unavailable = requests.Response()
+        unavailable.status_code = 503
+
+        def fail(data):
+            raise requests.HTTPError("503 Service Unavailable", response=unavailable)
+
+        q._post_data = fail
+        self.assertRaises(requests.HTTPError, q.post, document)
+        producer = BatchingProducer(q)
+        future = producer.post(document)
+        self.assertRaises(requests.HTTPError, future.result, 10)
+        producer.close()
+        self.assertEqual(0, sum(len(files) for _, _, files in os.walk(directory)))
+
+        # Those of messages the service may have stored are kept.
+        def drop(data):
+            raise requests.ConnectionError("Connection aborted.")
+
+        q._post_data = drop
+        self.assertRaises(requests.ConnectionError, q.post, document)
+        self.assertEqual(1, sum(len(files) for _, _, files in os.walk(directory)))
+        del q._post_data
+
+        # A missing blob only fails its own message.
+        q.post(document, "small")
+        for parent, _, files in os.walk(directory):
+            for name in files:
+                os.remove(os.path.join(parent, name))
+        messages = q.reserve(2)["messages"]
+        self.assertEqual("small", messages[1]["body"])
+        self.assertTrue(messages[0]["body"].startswith(ENVELOPE_PREFIX))
+        self.assertIsInstance(messages[0]["decode_error"], (IOError, OSError))
+
+    def test_deduplicator(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post({"body": "order 1", "dedup_key": "order-1"}, "other",
+               {"body": "order 1 again", "dedup_key": "order-1"})
+        message = q.peek(1)["messages"][0]
+        self.assertEqual(("order 1", "order-1"), (message["body"], message["dedup_key"]))
+
+        bodies = []
+        dedup = Deduplicator(ttl=60)
+        consumer = q.consumer(bodies.append, wait=1, ack_interval=0.1,
+                              dedup=dedup).start()
+        deadline = time.time() + 30
+        while q.size() and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(["order 1", "other"], [m["body"] for m in bodies])
+        self.assertEqual(1, dedup.duplicates)
+        self.assertFalse(dedup.begin({"id": "1", "dedup_key": "order-1"}))
+        self.assertTrue(dedup.begin({"id": bodies[1]["id"] + "0"}))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "seen.db")
+        first, second = Deduplicator(path=path), Deduplicator(path=path)
+        message = {"id": "1"}
+        self.assertTrue(first.begin(message))
+        self.assertIsNone(second.begin(message))
+        first.abort(message)
+        self.assertTrue(second.begin(message))
+        second.commit(message)
+        self.assertIs(False, first.begin(message))
+
+    def test_deduplicatorRedeliveryDuringProcessing(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post("slow")
+        attempts = []
+
+        def handle(message):
+            attempts.append(message["id"])
+            if len(attempts) == 1:
+                time.sleep(2.5)
+                raise ValueError("failed after the reservation expired")
+
+        consumer = q.consumer(handle, concurrency=2, wait=1, timeout=1,
+                              ack_interval=0.1, dedup=Deduplicator()).start()
+        deadline = time.time() + 30
+        while (len(attempts) < 2 or q.size()) and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(2, len(attempts))
+        self.assertEqual(0, q.size())
+
+    def test_provision(self):
+        prefix = "provision_%s_" % self.random_number
+        subscriber = {"name": "first", "url": "http://first.endpoint.xx/process"}
+        self.mq.create_queue(prefix + "existing", {"message_timeout": 60})
+        self.mq.create_queue(prefix + "unchanged", {"message_timeout": 90})
+        self.mq.create_queue(prefix + "obsolete")
+        spec = {
+            prefix + "new": {"message_timeout": 120},
+            prefix + "existing": {"message_timeout": 300, "type": "multicast",
+                                  "push": {"subscribers": [subscriber]}},
+            prefix + "unchanged": {"message_timeout": 90},
+        }
+
+        changes = self.mq.provision(spec, delete_missing=True, prefix=prefix,
+                                    dry_run=True)
+        self.assertEqual({prefix + "new": "create", prefix + "existing": "update",
+                          prefix + "unchanged": None, prefix + "obsolete": "delete"},
+                         dict((n, c.action) for n, c in changes.items()))
+        self.assertEqual((60, 300), changes[prefix + "existing"].changes["message_timeout"])
+        self.assertIn(prefix + "obsolete", self.mq.queues(prefix=prefix))
+
+        changes = self.mq.provision(spec, delete_missing=True, prefix=prefix)
+        self.assertTrue(all(c.ok for c in changes.values()))
+        self.assertEqual(sorted(spec), sorted(self.mq.queues(prefix=prefix)))
+        info = self.mq.queue(prefix + "existing").info()
+        self.assertEqual(300, info["message_timeout"])
+        self.assertEqual(["first"], [s["name"] for s in info["push"]["subscribers"]])
+
+        changes = self.mq.provision(spec, delete_missing=True, prefix=prefix)
+        self.assertEqual(set([None]), set(c.action for c in changes.values()))
+
+        self.assertRaises(ValueError, self.mq.provision, spec, delete_missing=True)
+
+        # A queue whose details fail to load is reported, not applied.
+        broken = prefix + "broken"
+        queue = self.mq.queue
+
+        def failing_queue(name, *args, **kwargs):
+            q = queue(name, *args, **kwargs)
+            if name == broken:
+                def fail():
+                    raise requests.HTTPError("500 Server Error")
+                q._fetch_info = fail
+            return q
+
+        self.mq.queue = failing_queue
+        changes = self.mq.provision(dict(spec, **{broken: {}}))
+        del self.mq.queue
+        self.assertFalse(changes[broken].ok)
+        self.assertIsNone(changes[broken].action)
+        self.assertNotIn(broken, self.mq.queues(prefix=prefix))
+        self.assertTrue(all(c.ok for n, c in changes.items() if n != broken))
+        for name in spec:
+            self.mq.queue(name).delete_queue()
+
+    def test_transfer(self):
+        source = self.mq.queue("transfer_source_%s" % self.random_number)
+        destination = self.mq.queue("transfer_destination_%s" % self.random_number)
+        source.post(*["msg %d" % i for i in range(30)] + ["skip me"])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint = os.path.join(directory, "checkpoint")
+        reports = []
+
+        stats = iron_mq.transfer(
+            source, destination, max_messages=20, batch=7, concurrency=3,
+            filter=lambda m: m["body"] != "skip me",
+            transform=lambda m: m["body"].upper(), checkpoint=checkpoint,
+            wait=0, progress=reports.append, progress_interval=0)
+        self.assertEqual(20, stats.moved)
+        self.assertIsNone(stats.error)
+        self.assertTrue(reports)
+        with open(checkpoint) as f:
+            self.assertEqual(20, len(f.read().split()))
+
+        # Resuming counts the moved messages towards max_messages.
+        stats = iron_mq.transfer(source, destination, max_messages=25,
+                                 checkpoint=checkpoint, wait=0)
+        self.assertEqual(5, stats.moved)
+
+        args = []
+        for key, value in self.http_config().items():
+            args += ["--" + key.replace("_", "-"), str(value)]
+        self.assertEqual(0, iron_mq.main(args + [
+            "transfer", source.name, destination.name, "--wait", "0"]))
+        bodies = []
+        while True:
+            messages = destination.reserve(max=100, wait=0)["messages"]
+            if not messages:
+                break
+            bodies += [m["body"] for m in messages]
+        self.assertEqual(31, len(bodies))
+        self.assertEqual(20, len([b for b in bodies if b.startswith("MSG")]))
+        self.assertEqual(set(["msg %d" % i for i in range(30)] + ["skip me"]),
+                         set(b.lower() for b in bodies))
+        self.assertEqual(0, source.info()["size"])
+        source.delete_queue()
+        destination.delete_queue()
+
+    def test_transferFailure(self):
+        source = self.mq.queue("transfer_source_%s" % self.random_number)
+        destination = self.mq.queue("transfer_destination_%s" % self.random_number)
+        source.post("a", "skip me", "b")
+
+        def fail(*messages):
+            raise ValueError("destination unavailable")
+
+        destination.post = fail
+        stats = iron_mq.transfer(source, destination, wait=0,
+                                 filter=lambda m: m["body"] != "skip me")
+        self.assertIsInstance(stats.error, ValueError)
+        self.assertEqual((0, 1, 2), (stats.moved, stats.filtered, stats.failed))
+        bodies = [m["body"] for m in source.reserve(max=10, wait=0)["messages"]]
+        self.assertEqual(["a", "b", "skip me"], sorted(bodies))
+        source.delete_queue()
+
+    def test_transferUndeleted(self):
+        source = self.mq.queue("transfer_source_%s" % self.random_number)
+        destination = self.mq.queue("transfer_destination_%s" % self.random_number)
+        ids = source.post(*["msg %d" % i for i in range(5)])["ids"]
+        unavailable = requests.Response()
+        unavailable.status_code = 500
+        delete = source.delete
+
+        def fail_batch(items):
+            raise requests.HTTPError("500 Server Error", response=unavailable)
+
+        def fail_one(message_id, reservation_id=None):
+            if message_id == ids[0]:
+                raise requests.HTTPError("500 Server Error", response=unavailable)
+            return delete(message_id, reservation_id)
+
+        source._delete_items = fail_batch
+        source.delete = fail_one
+        stats = iron_mq.transfer(source, destination, wait=0)
+        self.assertEqual((5, 1), (stats.moved, stats.undeleted))
+        self.assertIsInstance(stats.error, requests.HTTPError)
+        self.assertEqual(1, source.size())
+        source.delete_queue()
+        destination.delete_queue()
+
+    def test_transferDedupKey(self):
+        source = self.mq.queue("transfer_source_%s" % self.random_number)
+        destination = self.mq.queue("transfer_destination_%s" % self.random_number)
+        source.post({"body": "order 1", "dedup_key": "order-1"})
+        self.assertEqual(1, iron_mq.transfer(source, destination, wait=0).moved)
+        message = destination.peek(1)["messages"][0]
+        self.assertEqual(("order 1", "order-1"), (message["body"], message["dedup_key"]))
+        source.delete_queue()
+        destination.delete_queue()
+
+    def test_reserveLongPoll(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post({"body": "delayed", "delay": 2})
+        self.assertEqual(0, len(q.reserve()["messages"]))
+        started = time.time()
+        messages = q.reserve(wait=10)["messages"]
+        self.assertEqual(1, len(messages))
+        self.assertTrue(time.time() - started < 9)
+
+    def test_batchingProducer(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        producer = q.producer(max_batch=10, linger_ms=50)
+        futures = [producer.post("message %s" % i) for i in range(25)]
+        producer.close()
+        ids = [future.result() for future in futures]
+        self.assertEqual(25, len(set(ids)))
+        self.assertEqual(25, q.size())
+        self.assertEqual("message 3", q.get_message_by_id(ids[3])["body"])
+
+    def test_consumer(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post(*["message %s" % i for i in range(20)])
+        bodies = []
+        consumer = q.consumer(bodies.append, concurrency=4, prefetch=10,
+                              wait=1, ack_interval=0.1).start()
+        deadline = time.time() + 30
+        while len(bodies) < 20 and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(20, len(bodies))
+        self.assertEqual(0, q.size())
+
+    def test_reserveTuner(self):
+        tuner = ReserveTuner(max_wait=10)
+        self.assertEqual({"max": 1, "wait": 10, "timeout": None}, tuner.params())
+        for i in range(3):
+            n = tuner.params()["max"]
+            tuner.reserved(n, n)
+        self.assertEqual({"max": 8, "wait": 0, "timeout": None}, tuner.params())
+        for i in range(20):
+            tuner.reserved(8, 0)
+        for i in range(100):
+            tuner.processed(i + 1)
+        params = tuner.params(backlog=9, concurrency=2)
+        self.assertEqual(1, params["max"])
+        self.assertTrue(0 < params["wait"] <= 10)
+        self.assertEqual(100 * 2 + 253, params["timeout"])
+        self.assertEqual(23, tuner.decisions()["reserves"])
+
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post(*["message %s" % i for i in range(50)])
+        bodies = []
+        tuner = ReserveTuner(max_wait=1)
+        consumer = q.consumer(bodies.append, concurrency=4, prefetch=100,
+                              ack_interval=0.1, tuner=tuner).start()
+        deadline = time.time() + 30
+        while len(bodies) < 50 and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(50, len(bodies))
+        self.assertTrue(tuner.reserves > 1)
+
+    def test_processConsumer(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post(*[str(i) for i in range(20)] + ["not a number"])
+        results = {}
+        consumer = ProcessConsumer(
+            q, int, processes=2, chunk_size=4, wait=1, ack_interval=0.1,
+            callback=lambda message, result: results.update({message["body"]: result}))
+        consumer.start()
+        deadline = time.time() + 30
+        while len(results) < 20 and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(dict((str(i), i) for i in range(20)), results)
+        self.assertEqual(["not a number"], [m["body"] for m in q.peek()["messages"]])
+
+    def test_processConsumerWorkerDies(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        q = self.mq.queue("test_queue")
+        q.clear()
+        bodies = ["crash:" + os.path.join(directory, "crashed")]
+        bodies += ["message %d" % i for i in range(5)]
+        q.post(*bodies)
+        results = []
+        consumer = ProcessConsumer(
+            q, _crash_once, processes=2, chunk_size=1, wait=1, ack_interval=0.1,
+            callback=lambda message, result: results.append(result))
+        consumer.start()
+        deadline = time.time() + 60
+        while len(results) < 6 and time.time() < deadline:
+            time.sleep(0.1)
+        consumer.stop()
+        self.assertTrue(consumer.join(60))
+        self.assertEqual(sorted(bodies), sorted(results))
+        self.assertEqual(0, q.size())
+
+    def test_pooledTransport(self):
+        transport = PooledTransport(pool_size=2, idle_timeout=0.5)
+        self.addCleanup(transport.close)
+        mq = IronMQ(transport=transport, **self.http_config())
+        events = []
+        mq.add_observer(events.append)
+        q = mq.queue("test_queue")
+        q.clear()
+        for i in range(10):
+            q.post("message %d" % i)
+        self.assertEqual(10, q.size())
+        self.assertEqual({"requests": 12, "connections": 1, "reused": 11,
+                          "evicted": 0},
+                         dict((k, v) for k, v in transport.stats().items()
+                              if k != "wait_time"))
+        self.assertTrue(all(e.pool_wait_time < 1 for e in events))
+
+        time.sleep(0.6)
+        q.size()
+        stats = transport.stats()
+        self.assertEqual(1, stats["evicted"])
+        self.assertEqual(2, stats["connections"])
+
+    def test_asyncClient(self):
+        import asyncio
+
+        async def roundtrip():
+            async with self.async_mq() as mq:
+                q = mq.queue("test_queue")
+                await q.clear()
+                ids = (await q.post("first", "second"))["ids"]
+                results = await asyncio.gather(q.reserve(1), q.reserve(1))
+                messages = {"messages": [r["messages"][0] for r in results]}
+                self.assertEqual(set(ids), set(m["id"] for m in messages["messages"]))
+                await q.delete_multiple(messages=messages)
+                return await q.size()
+
+        self.assertEqual(0, asyncio.run(roundtrip()))
+
+    def test_leaseManager(self):
+        q = self.mq.queue("test_queue")
+        q.clear()
+        q.post("first", "second")
+        messages = q.reserve(2, timeout=30)
+        with q.leases(timeout=30, margin=28) as leases:
+            leases.track(messages)
+            time.sleep(5)
+            message_id = messages["messages"][0]["id"]
+            self.assertNotEqual(messages["messages"][0]["reservation_id"],
+                                leases.reservation_id(message_id))
+            leases.delete_multiple([m["id"] for m in messages["messages"]])
+        self.assertEqual(0, q.size())
+
+    def http_config(self):
+        """Keyword arguments of a client of the service over HTTP."""
+        if self.fake is None:
+            return {}
+        server = self.fake.serve()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.config
+
+    def async_mq(self):
+        from iron_mq_async import AsyncIronMQ
+        return AsyncIronMQ(**self.http_config())
+
 
 if __name__ == '__main__':
     unittest.main()